@@ -0,0 +1,280 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Benchmarks of python-scratchbox overhead.
+
+Real scratchbox tools are replaced by bench/fake-sb shell script and tools
+rootstraps are served by local HTTP server, so only the library is
+measured.
+
+Usage: python bench/run.py [--repeat N] [--json] [benchmark...]
+
+Every result is printed as one line "<name> <value> <unit>" sorted by
+name (or as JSON object per line with --json). Values are medians of
+the repeats, so results of different versions can be compared directly.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from optparse import OptionParser
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+from scratchbox.sb1 import Scratchbox1
+from scratchbox.sb2 import Scratchbox2, ToolsRootstrap
+from scratchbox.templates import TemplateStore
+from scratchbox.remote import WorkerServer, RemoteScratchbox
+from scratchbox.capture import MemoryConsumer, CallbackConsumer
+
+from server import RootstrapServer, make_tools, make_rootstrap
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+TOOLS = ("sb2", "sb2-init", "sb2-config", "sb-conf", "login")
+MB = 1 << 20
+
+class Environment(object):
+    """Temporary home directory and stand-in scratchbox tools."""
+
+    def __init__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="sb-bench-")
+        self.bindir = os.path.join(self.tmpdir, "bin")
+        self.home = os.path.join(self.tmpdir, "home")
+        os.makedirs(self.bindir)
+        os.makedirs(self.home)
+        for tool in TOOLS:
+            os.symlink(os.path.join(BENCHDIR, "fake-sb"),
+                       os.path.join(self.bindir, tool))
+        self.saved_env = os.environ.copy()
+        os.environ["HOME"] = self.home
+        os.environ["PATH"] = "%s:%s" % (self.bindir, os.environ["PATH"])
+        os.environ.setdefault("USER", "bench")
+        os.environ["FAKE_SB_TARGETS"] = "bench"
+
+    def path(self, *names):
+        """Return path inside temporary directory."""
+        return os.path.join(self.tmpdir, *names)
+
+    def sb1(self):
+        """Return Scratchbox1 object using fake tools."""
+        sbox = Scratchbox1()
+        sbox.exe = os.path.join(self.bindir, "login")
+        return sbox
+
+    def sb2(self, target="bench"):
+        """Return Scratchbox2 object using fake tools."""
+        sbox = Scratchbox2()
+        sbox.exe = os.path.join(self.bindir, "sb2")
+        sbox.sb2init = os.path.join(self.bindir, "sb2-init")
+        sbox.sb2config = os.path.join(self.bindir, "sb2-config")
+        sbox.set_target_name(target)
+        return sbox
+
+    def cleanup(self):
+        """Remove temporary files and restore environment."""
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.tmpdir, True)
+
+def median(values):
+    """Return median of values."""
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def measure(func, repeat):
+    """Call func repeat times. Return: median wall time."""
+
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return median(times)
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """Register benchmark function."""
+    BENCHMARKS.append(func)
+    return func
+
+@benchmark
+def run_overhead(env, repeat):
+    """Per-call cost of run() with zero-latency tools."""
+
+    calls = 50
+    sbox = env.sb2()
+    yield ("run.sb2.per_call",
+           measure(lambda: [sbox.run("true") for _ in range(calls)],
+                   repeat) / calls * 1000, "ms")
+    sbox1 = env.sb1()
+    yield ("run.sb1.per_call",
+           measure(lambda: [sbox1.run("true") for _ in range(calls)],
+                   repeat) / calls * 1000, "ms")
+    yield ("run_many.sb2.per_call",
+           measure(lambda: sbox.run_many(["true"] * calls),
+                   repeat) / calls * 1000, "ms")
+    sbox.start_server()
+    try:
+        yield ("run.sb2_server.per_call",
+               measure(lambda: [sbox.run("true") for _ in range(calls)],
+                       repeat) / calls * 1000, "ms")
+    finally:
+        sbox.stop_server()
+
+@benchmark
+def tee_throughput(env, repeat):
+    """Throughput of _tee() for different amounts of output."""
+
+    sbox = env.sb2()
+    logfn = env.path("tee.log")
+    for size in (1, 16, 128):
+        for kind, source in (("bulk", "cat /dev/zero"),
+                             ("lines", "yes 0123456789abcdef")):
+            command = "sh -c '%s | head -c %d'" % (source, size * MB)
+            elapsed = measure(lambda: sbox.tee(command, logfn, "devel"),
+                              repeat)
+            yield ("tee.%s.%dM" % (kind, size), size / elapsed, "MB/s")
+
+    # the same with output passed to consumers on their own threads
+    command = "sh -c 'cat /dev/zero | head -c %d'" % (128 * MB)
+    elapsed = measure(lambda: sbox.tee(command, logfn, "devel",
+                      consumers=[MemoryConsumer(MB),
+                                 CallbackConsumer(lambda data: None)]),
+                      repeat)
+    yield ("tee.fanout.128M", 128 / elapsed, "MB/s")
+
+@benchmark
+def tools_download(env, repeat):
+    """Download and extraction of tools rootstrap from local server."""
+
+    docroot = env.path("www")
+    path = make_tools(docroot, nfiles=400, size=128 * 1024)
+    server = RootstrapServer(docroot)
+    server.start()
+    saved = (ToolsRootstrap.basedir, ToolsRootstrap.streaming)
+    try:
+        for streaming in (False, True):
+            ToolsRootstrap.streaming = streaming
+
+            def download():
+                ToolsRootstrap.basedir = tempfile.mkdtemp(dir=env.tmpdir)
+                rootstrap = ToolsRootstrap(server.url(path))
+                rootstrap.get_tools_dir()
+                rootstrap.remove_lock()
+                shutil.rmtree(ToolsRootstrap.basedir)
+
+            name = streaming and "streaming" or "segmented"
+            yield ("tools_download.%s" % name, measure(download, repeat), "s")
+    finally:
+        ToolsRootstrap.basedir, ToolsRootstrap.streaming = saved
+        server.stop()
+
+@benchmark
+def target_setup(env, repeat):
+    """Latency of setup() and extract_rootstrap()."""
+
+    sbox = env.sb2()
+    yield ("setup.sb2", measure(lambda: sbox.setup({"name": "bench"},
+                                                   force=True), repeat), "s")
+
+    rootstrap = env.path("rootstrap.tgz")
+    make_rootstrap(rootstrap, nfiles=2000, size=16 * 1024)
+    store = TemplateStore(env.path("templates"))
+    for name, template_store in (("tar", None), ("template", store)):
+        sbox.template_store = template_store
+
+        def extract():
+            targetdir = sbox.get_targetdir()
+            if os.path.exists(targetdir):
+                shutil.rmtree(targetdir)
+            os.makedirs(targetdir)
+            sbox.extract_rootstrap(rootstrap)
+
+        yield ("extract_rootstrap.sb2.%s" % name, measure(extract, repeat),
+               "s")
+
+@benchmark
+def remote_workers(env, repeat):
+    """Overhead of jobs placed on worker daemons running on localhost."""
+
+    token = "bench"
+    servers = [WorkerServer(("127.0.0.1", 0), env.sb2, token)
+               for _ in range(2)]
+    for server in servers:
+        server.start()
+    try:
+        sbox = RemoteScratchbox([server.get_address() for server in servers],
+                                "bench", token)
+        calls = 20
+        yield ("remote.run.per_call",
+               measure(lambda: [sbox.run("true") for _ in range(calls)],
+                       repeat) / calls * 1000, "ms")
+        command = "sh -c 'cat /dev/zero | head -c %d'" % (128 * MB)
+        elapsed = measure(lambda: sbox.tee(command, env.path("remote.log"),
+                                           "devel"), repeat)
+        yield ("remote.tee.bulk.128M", 128 / elapsed, "MB/s")
+    finally:
+        for server in servers:
+            server.stop()
+
+def main(argv):
+    """Run benchmarks and print results."""
+
+    parser = OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="number of repeats [%default]")
+    parser.add_option("-j", "--json", action="store_true",
+                      help="print results as JSON lines")
+    options, names = parser.parse_args(argv)
+
+    results = []
+    env = Environment()
+    try:
+        for func in BENCHMARKS:
+            if names and func.__name__ not in names:
+                continue
+            results.extend(func(env, options.repeat))
+    finally:
+        env.cleanup()
+
+    results.sort()
+    for name, value, unit in results:
+        if options.json:
+            print json.dumps({"benchmark": name, "value": value,
+                              "unit": unit}, sort_keys=True)
+        else:
+            print "%-32s %12.4f %s" % (name, value, unit)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Local HTTP server with synthetic tools rootstraps for benchmarks.
+"""
+
+import os
+import re
+import random
+import urllib
+import posixpath
+import tarfile
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+
+from cStringIO import StringIO
+
+def make_rootstrap(path, nfiles=200, size=65536, seed=0):
+    """Create gzipped tarball with nfiles files of given size."""
+
+    rand = random.Random(seed)
+    tar = tarfile.open(path, "w:gz")
+    try:
+        for i in range(nfiles):
+            data = "".join([chr(rand.randint(0, 255)) for _ in range(256)])
+            data = (data * (size / 256 + 1))[:size]
+            info = tarfile.TarInfo("usr/lib/tool%d/file%d" % (i % 10, i))
+            info.size = len(data)
+            info.mode = 0644
+            tar.addfile(info, StringIO(data))
+    finally:
+        tar.close()
+
+def make_tools(docroot, name="tools", **kwargs):
+    """Create <docroot>/<name>/ with .full and -rootstrap.tgz files.
+       Return: URL path of tools rootstrap.
+    """
+
+    tdir = os.path.join(docroot, name)
+    if not os.path.isdir(tdir):
+        os.makedirs(tdir)
+    make_rootstrap(os.path.join(tdir, name + "-rootstrap.tgz"), **kwargs)
+    open(os.path.join(tdir, name + ".full"), "w").write("%s %s\n" % \
+                                                        (name, kwargs))
+    return "/%s/" % name
+
+class RangeFile(object):
+    """File object returning at most length bytes from offset."""
+
+    def __init__(self, fobj, offset, length):
+        self.fobj = fobj
+        self.left = length
+        fobj.seek(offset)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+        data = self.fobj.read(size)
+        self.left -= len(data)
+        return data
+
+    def close(self):
+        self.fobj.close()
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Request handler serving docroot which doesn't log requests.
+       Single byte ranges are supported.
+    """
+
+    docroot = "."
+    # break connection after that many bytes of every response, for
+    # testing of resumed downloads
+    break_after = None
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+    def send_head(self):
+        header = self.headers.getheader("Range")
+        path = self.translate_path(self.path)
+        if not header or os.path.isdir(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        try:
+            fobj = open(path, "rb")
+        except IOError:
+            self.send_error(404, "File not found")
+            return None
+        fstat = os.fstat(fobj.fileno())
+        size = fstat.st_size
+        match = re.match(r"bytes=(\d*)-(\d*)$", header)
+        start = end = None
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = size - 1
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+        elif match and match.group(2):
+            start = max(0, size - int(match.group(2)))
+            end = size - 1
+        if start is None or start > end:
+            fobj.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.end_headers()
+            return None
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes %d-%d/%d" % \
+                         (start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified",
+                         self.date_time_string(fstat.st_mtime))
+        self.end_headers()
+        return RangeFile(fobj, start, end - start + 1)
+
+    def copyfile(self, source, outputfile):
+        if self.break_after is None:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self,
+                source, outputfile)
+        outputfile.write(source.read(self.break_after))
+        self.close_connection = 1
+
+    def translate_path(self, path):
+        path = path.split("?", 1)[0].split("#", 1)[0]
+        path = posixpath.normpath(urllib.unquote(path))
+        words = [word for word in path.split("/")
+                 if word and word not in (os.curdir, os.pardir)]
+        return os.path.join(self.docroot, *words)
+
+    def log_message(self, *args):
+        pass
+
+class RootstrapServer(object):
+    """HTTP server serving docroot on localhost in background thread."""
+
+    def __init__(self, docroot, handler=QuietHandler, break_after=None):
+        self.docroot = docroot
+        class Handler(handler):
+            """Handler bound to docroot."""
+            pass
+        Handler.docroot = docroot
+        Handler.break_after = break_after
+        handler = Handler
+        self.httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+
+    def start(self):
+        """Start serving."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.httpd.shutdown()
+
+    def url(self, path):
+        """Return URL of path."""
+        return "http://127.0.0.1:%d%s" % (self.port, path)
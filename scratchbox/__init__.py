@@ -26,15 +26,22 @@ Scratchbox API. Factory.
 """
 
 
-def scratchbox_factory(sbver=1):
-    """Factory. Create scratchbox objects."""
+def scratchbox_factory(sbver=1, async_=False):
+    """Factory. Create scratchbox objects.
+       If async_ is set, non-blocking AsyncScratchbox wrapper is returned.
+    """
     sbver = int(sbver)
     if sbver == 1:
         from scratchbox.sb1 import Scratchbox1
-        return Scratchbox1()
+        sbox = Scratchbox1()
     elif sbver == 2:
         from scratchbox.sb2 import Scratchbox2
-        return Scratchbox2()
+        sbox = Scratchbox2()
     else:
         from scratchbox.common import SBError
         raise SBError("Unknown version of scratchbox: %d" % sbver)
+
+    if async_:
+        from scratchbox.asyncsb import AsyncScratchbox
+        return AsyncScratchbox(sbox)
+    return sbox
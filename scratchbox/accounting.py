@@ -0,0 +1,143 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Resource accounting of commands.
+
+Resource usage of the command's process tree (CPU time, peak memory,
+block I/O, context switches) is taken from wait4() when the command
+exits. Usage is summed per target and per operation, so cost of build
+steps can be compared between targets and over time.
+"""
+
+import threading
+
+class ResourceUsage(object):
+    """Resources used by one command or summed over many commands.
+       maxrss is in kilobytes; for sums it's the peak of all commands.
+    """
+
+    fields = ("utime", "stime", "maxrss", "inblock", "oublock", "nvcsw",
+              "nivcsw", "wall")
+
+    def __init__(self, rusage=None, wall=0.0):
+        self.count = 0
+        for field in self.fields:
+            setattr(self, field, 0)
+        self.wall = wall
+        if rusage is not None:
+            self.count = 1
+            self.utime = rusage.ru_utime
+            self.stime = rusage.ru_stime
+            self.maxrss = rusage.ru_maxrss
+            self.inblock = rusage.ru_inblock
+            self.oublock = rusage.ru_oublock
+            self.nvcsw = rusage.ru_nvcsw
+            self.nivcsw = rusage.ru_nivcsw
+
+    def get_cpu(self):
+        """Return user and system CPU time in seconds."""
+        return self.utime + self.stime
+
+    def add(self, usage):
+        """Add usage of another command."""
+
+        for field in self.fields:
+            if field == "maxrss":
+                self.maxrss = max(self.maxrss, usage.maxrss)
+            else:
+                setattr(self, field, getattr(self, field) + \
+                                     getattr(usage, field))
+        self.count += usage.count
+
+    def as_dict(self):
+        """Return usage as dictionary."""
+
+        result = {"count": self.count}
+        for field in self.fields:
+            result[field] = getattr(self, field)
+        return result
+
+    def __repr__(self):
+        return "<ResourceUsage cpu=%.2fs maxrss=%dk wall=%.2fs count=%d>" % \
+               (self.get_cpu(), self.maxrss, self.wall, self.count)
+
+class Accounting(object):
+    """Sums resource usage of commands per operation and target."""
+
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, target, usage):
+        """Account usage of command run by operation in target."""
+
+        if usage is None:
+            return
+        self.lock.acquire()
+        try:
+            for key in ((operation, target), (None, target),
+                        (operation, None), (None, None)):
+                if key not in self.totals:
+                    self.totals[key] = ResourceUsage()
+                self.totals[key].add(usage)
+        finally:
+            self.lock.release()
+
+    def get_usage(self, target=None, operation=None):
+        """Return summed usage of target and operation.
+           None means all targets or all operations.
+        """
+
+        self.lock.acquire()
+        try:
+            result = ResourceUsage()
+            if (operation, target) in self.totals:
+                result.add(self.totals[(operation, target)])
+            return result
+        finally:
+            self.lock.release()
+
+    def get_targets(self):
+        """Return list of targets which have accounted commands."""
+
+        self.lock.acquire()
+        try:
+            targets = [target for operation, target in self.totals
+                       if operation is None and target is not None]
+        finally:
+            self.lock.release()
+        targets.sort()
+        return targets
+
+    def reset(self):
+        """Drop collected usage."""
+
+        self.lock.acquire()
+        try:
+            self.totals = {}
+        finally:
+            self.lock.release()
+
+# resource usage of commands run by all scratchbox objects in the process
+accounting = Accounting()
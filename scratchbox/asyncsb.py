@@ -0,0 +1,369 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Non-blocking wrapper around scratchbox objects.
+
+Python 2 has no asyncio, so commands are multiplexed by one reactor
+thread using select(). Every call returns a Job which can be waited for
+or given a callback, so one process can drive many sandbox jobs at once.
+"""
+
+import os
+import errno
+import select
+import threading
+import logging
+import Queue
+
+from scratchbox.common import SBError, Process, check_status
+from scratchbox.capture import LogCapture, TeeResult, CHUNK_SIZE
+from scratchbox.accounting import accounting
+
+class Job(object):
+    """Result of an operation which is not finished yet."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        """Return True if the job is finished."""
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish. Return: True if it's finished."""
+        self.event.wait(timeout)
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        """Return result of the job or raise its error."""
+        if not self.wait(timeout):
+            raise SBError("Timeout waiting for the job")
+        if self.error:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        """Call callback(job) when the job is finished."""
+
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        callback(self)
+
+    def set_result(self, value, error=None):
+        """Finish the job."""
+
+        self.lock.acquire()
+        try:
+            self.value = value
+            self.error = error
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def set_error(self, error):
+        """Finish the job with error."""
+        self.set_result(None, error)
+
+class ProcessJob(Job):
+    """Command running outside of the caller's thread.
+       Its output is either collected in memory or written to a log.
+    """
+
+    def __init__(self, command, directory=None, capture=None, finish=None):
+        Job.__init__(self)
+        self.command = command
+        self.capture = capture
+        self.finish = finish
+        self.output = []
+        # log is opened first: if it fails, there is no child left behind
+        if self.capture:
+            try:
+                self.capture.open()
+            except:
+                self.capture.close()
+                raise
+        devnull = open(os.devnull)
+        try:
+            self.proc = Process(command, directory, stdin=devnull)
+        except:
+            devnull.close()
+            if self.capture:
+                self.capture.close()
+            raise
+        devnull.close()
+
+    def fileno(self):
+        """Return descriptor of the output pipe."""
+        return self.proc.stdout.fileno()
+
+    def read(self):
+        """Read available output. Return: False on EOF."""
+
+        data = os.read(self.fileno(), CHUNK_SIZE)
+        if not data:
+            return False
+        if self.capture:
+            self.capture.feed(data)
+        else:
+            self.output.append(data)
+        return True
+
+    def close(self):
+        """Close the output pipe and the log."""
+
+        self.proc.stdout.close()
+        if self.capture:
+            self.capture.close()
+
+    def poll(self):
+        """Check if the command exited. Return: True if it did."""
+
+        status = self.proc.poll()
+        if status is None:
+            return False
+        output = "".join(self.output)
+        if output[-1:] == "\n":
+            output = output[:-1]
+        try:
+            self.set_result(self.finish(status, output, self.proc.usage))
+        except Exception, exobj:
+            self.set_error(exobj)
+        return True
+
+class Reactor(object):
+    """One thread multiplexing output of all running commands."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.reaping = []
+        self.lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, job):
+        """Start serving output of the job."""
+
+        self.lock.acquire()
+        try:
+            self.jobs[job.fileno()] = job
+            if not self.thread:
+                self.thread = threading.Thread(target=self.loop)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        os.write(self.wakeup_w, "x")
+
+    def loop(self):
+        """Reactor thread."""
+
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.jobs and not self.reaping:
+                    # nothing to serve, next add() starts new thread
+                    self.thread = None
+                    return
+                fds = self.jobs.keys()
+            finally:
+                self.lock.release()
+
+            # exited children are polled, there is no fd to wait for
+            timeout = None
+            if self.reaping:
+                timeout = 0.01
+            try:
+                rlist = select.select(fds + [self.wakeup_r], [], [],
+                                      timeout)[0]
+            except select.error, exobj:
+                if exobj.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fileno in rlist:
+                if fileno == self.wakeup_r:
+                    os.read(fileno, 4096)
+                    continue
+                job = self.jobs[fileno]
+                try:
+                    more = job.read()
+                except (IOError, OSError), exobj:
+                    self.logger.error("reading output of %s failed: %s" % \
+                                      (job.command, exobj))
+                    more = False
+                if not more:
+                    # fd can be reused by add() as soon as it's closed
+                    self.lock.acquire()
+                    del self.jobs[fileno]
+                    self.lock.release()
+                    try:
+                        job.close()
+                    except (IOError, OSError), exobj:
+                        self.logger.error("closing log of %s failed: %s" % \
+                                          (job.command, exobj))
+                    self.reaping.append(job)
+
+            for job in self.reaping[:]:
+                if job.poll():
+                    self.reaping.remove(job)
+
+class AsyncScratchbox(object):
+    """Non-blocking counterpart of Scratchbox objects.
+
+       run(), tee() and superuser_tee() are served by the reactor thread.
+       Composite operations (setup, extract_rootstrap, tools rootstrap
+       download) run on a small pool of helper threads. All of them return
+       Job objects. Other attributes are taken from the wrapped object.
+    """
+
+    reactor = None
+
+    def __init__(self, sbox, workers=4):
+        self.sbox = sbox
+        self.workers = workers
+        self.threads = []
+        self.queue = Queue.Queue()
+        self.rootstraps = []
+        if not AsyncScratchbox.reactor:
+            AsyncScratchbox.reactor = Reactor()
+
+    def __getattr__(self, name):
+        return getattr(self.sbox, name)
+
+    def _spawn(self, command, directory=None, capture=None, finish=None):
+        """Start command and register it in the reactor."""
+
+        job = Job()
+        try:
+            process = ProcessJob(command, directory, capture, finish)
+        except (IOError, OSError), exobj:
+            job.set_error(SBError("Can't run %s: %s" % (command, exobj)))
+            return job
+        process.add_done_callback(lambda pjob:
+                                  job.set_result(pjob.value, pjob.error))
+        self.reactor.add(process)
+        return job
+
+    def _submit(self, func, *args):
+        """Run func(*args) on helper thread."""
+
+        job = Job()
+        self.queue.put((job, func, args))
+        if len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+        return job
+
+    def _worker(self):
+        """Helper thread."""
+
+        while True:
+            job, func, args = self.queue.get()
+            try:
+                value = func(*args)
+            except Exception, exobj:
+                job.set_error(exobj)
+            else:
+                job.set_result(value)
+
+    def run(self, command, directory=None, exe=None, fatal=True):
+        """Run command inside scratchbox."""
+
+        if not exe:
+            exe = self.sbox.exe
+        cmdl = "%s %s" % (exe, command)
+        self.sbox.logger.debug("running command: %s" % cmdl)
+        return self._spawn(cmdl, directory,
+                           finish=lambda status, output, usage:
+                           check_status(cmdl, status, output, fatal))
+
+    def _tee(self, command, logfn, bufsize=0, compress=None, tail=0,
+             consumers=None):
+        """Run command writing its output to the log file."""
+
+        capture = LogCapture(logfn, bufsize, compress, tail, consumers)
+
+        def finish(status, output, usage):
+            accounting.record("tee", self.sbox.target_name, usage)
+            if os.WIFEXITED(status):
+                return TeeResult(os.WEXITSTATUS(status), capture, usage)
+            return TeeResult(-1, capture, usage)
+
+        return self._spawn("%s %s" % (self.sbox.exe, command),
+                           capture=capture, finish=finish)
+
+    def tee(self, command, logfn, mode, bufsize=0, compress=None, tail=0,
+            consumers=None):
+        """Tee."""
+        return self._tee(self.sbox.get_tee_command(command, mode),
+                         logfn, bufsize, compress, tail, consumers)
+
+    def superuser_tee(self, command, logfn, mode, bufsize=0, compress=None,
+                      tail=0, consumers=None):
+        """Tee with root privileges."""
+        return self._tee(self.sbox.get_tee_command(command, mode, True),
+                         logfn, bufsize, compress, tail, consumers)
+
+    def setup(self, target, force=None):
+        """Setup target."""
+        return self._submit(self.sbox.setup, target, force)
+
+    def extract_rootstrap(self, rootstrap):
+        """Extracts given rootstrap into target."""
+        return self._submit(self.sbox.extract_rootstrap, rootstrap)
+
+    def get_tools_dir(self, tools_url):
+        """Download tools rootstrap. Job result is path to the tools.
+           Tools rootstrap is locked until release() is called.
+        """
+
+        from scratchbox.sb2 import ToolsRootstrap
+        rootstrap = ToolsRootstrap(tools_url)
+        self.rootstraps.append(rootstrap)
+        return rootstrap.prefetch()
+
+    def release(self):
+        """Release acquired resources."""
+
+        for rootstrap in self.rootstraps:
+            rootstrap.job.wait()
+            rootstrap.remove_lock()
+        self.rootstraps = []
+        self.sbox.release()
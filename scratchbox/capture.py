@@ -0,0 +1,476 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Capturing of command output to log files.
+
+Besides the log file, output can be passed to any number of consumers
+(files, callbacks, sockets, memory buffers). Every consumer is served by
+its own thread through a bounded queue. When the queue is full, the
+consumer's policy decides what happens:
+    block       - reading of command output waits for the consumer
+    drop-oldest - the oldest queued chunk is dropped
+    spill       - data goes to a temporary file and is passed to the
+                  consumer later, in order
+"""
+
+import os
+import time
+import gzip
+import bz2
+import socket
+import tempfile
+import threading
+import logging
+import Queue
+
+from collections import deque
+
+CHUNK_SIZE = 65536
+
+class TailBuffer(object):
+    """Ring buffer keeping last size bytes of output."""
+
+    def __init__(self, size):
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+
+    def feed(self, data):
+        """Append data, dropping the oldest chunks which don't fit."""
+
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def get(self):
+        """Return buffered data."""
+        return "".join(self.chunks)[-self.size:]
+
+class CompressedWriter(object):
+    """Compresses log on background thread.
+       The queue is not bounded, so slow compression never stalls the
+       reader of the child's pipe.
+    """
+
+    openers = {"gzip": gzip.GzipFile, "bz2": bz2.BZ2File}
+
+    def __init__(self, logfn, method):
+        if method not in self.openers:
+            raise ValueError("Unknown compression method: %s" % method)
+        self.logfile = self.openers[method](logfn, "wb")
+        self.queue = Queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._write)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _write(self):
+        """Compressing thread."""
+
+        try:
+            try:
+                while True:
+                    data = self.queue.get()
+                    if data is None:
+                        break
+                    self.logfile.write(data)
+            finally:
+                self.logfile.close()
+        except (IOError, OSError), exobj:
+            self.error = exobj
+
+    def write(self, data):
+        """Queue data for compression."""
+        self.queue.put(data)
+
+    def close(self):
+        """Flush everything to the log file."""
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise IOError("Can't write compressed log: %s" % self.error)
+
+POLICIES = ("block", "drop-oldest", "spill")
+
+class Consumer(object):
+    """Base class of output consumers."""
+
+    # what to do when the consumer doesn't keep up, see POLICIES
+    policy = "block"
+
+    def __init__(self, policy=None):
+        if policy:
+            self.policy = policy
+
+    def write(self, data):
+        """Consume chunk of output."""
+        raise NotImplementedError
+
+    def close(self):
+        """Output is finished."""
+        pass
+
+class FileConsumer(Consumer):
+    """Writes output to a file."""
+
+    def __init__(self, path, policy=None):
+        Consumer.__init__(self, policy)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+
+    def write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close(self):
+        os.close(self.fd)
+
+class CallbackConsumer(Consumer):
+    """Calls callback(data) for every chunk of output."""
+
+    policy = "spill"
+
+    def __init__(self, callback, policy=None):
+        Consumer.__init__(self, policy)
+        self.callback = callback
+
+    def write(self, data):
+        self.callback(data)
+
+class SocketConsumer(Consumer):
+    """Sends output to a connected socket or to (host, port) address.
+       Sockets connected by the consumer are closed by it.
+    """
+
+    policy = "spill"
+
+    def __init__(self, sock, policy=None):
+        Consumer.__init__(self, policy)
+        self.own = isinstance(sock, tuple)
+        if self.own:
+            address, sock = sock, socket.socket(socket.AF_INET,
+                                                socket.SOCK_STREAM)
+            sock.connect(address)
+        self.sock = sock
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        if self.own:
+            self.sock.close()
+
+class MemoryConsumer(Consumer):
+    """Keeps output in memory, last limit bytes only if limit is set."""
+
+    def __init__(self, limit=None, policy=None):
+        Consumer.__init__(self, policy)
+        self.chunks = []
+        self.tail = None
+        if limit:
+            self.tail = TailBuffer(limit)
+
+    def write(self, data):
+        if self.tail:
+            self.tail.feed(data)
+        else:
+            self.chunks.append(data)
+
+    def get_data(self):
+        """Return kept output."""
+        if self.tail:
+            return self.tail.get()
+        return "".join(self.chunks)
+
+class Channel(object):
+    """Bounded queue and thread serving one consumer."""
+
+    def __init__(self, consumer, maxchunks):
+        if consumer.policy not in POLICIES:
+            raise ValueError("Unknown policy: %s" % consumer.policy)
+        self.consumer = consumer
+        self.queue = Queue.Queue(maxchunks)
+        self.lock = threading.Lock()
+        self.spill = None
+        self.spill_pos = 0
+        self.spilling = False
+        self.dropped = 0
+        self.spilled = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, data):
+        """Queue data according to the consumer's policy."""
+
+        if self.error and data is not None:
+            return
+        policy = self.consumer.policy
+        if policy == "block" or data is None:
+            if not self._spill(data):
+                self.queue.put(data)
+            return
+        while True:
+            if self._spill(data):
+                return
+            try:
+                self.queue.put_nowait(data)
+                return
+            except Queue.Full:
+                pass
+            if policy == "spill":
+                self.lock.acquire()
+                try:
+                    self.spilling = True
+                finally:
+                    self.lock.release()
+                continue
+            try:
+                self.dropped += len(self.queue.get_nowait() or "")
+            except Queue.Empty:
+                pass
+
+    def _spill(self, data):
+        """Append data to the spill file if spilling is in progress.
+           Return: True if data was spilled.
+        """
+
+        self.lock.acquire()
+        try:
+            if not self.spilling:
+                return False
+            if data is None:
+                # end of output is queued after the spilled data
+                self.spilling = "closing"
+                return True
+            if not self.spill:
+                self.spill = tempfile.TemporaryFile(prefix="sb-spill-")
+            self.spill.seek(0, 2)
+            self.spill.write(data)
+            self.spilled += len(data)
+            return True
+        finally:
+            self.lock.release()
+
+    def _unspill(self):
+        """Return next chunk of spilled data or None if there is none."""
+
+        self.lock.acquire()
+        try:
+            if not self.spilling:
+                return None
+            data = ""
+            if self.spill:
+                self.spill.seek(self.spill_pos)
+                data = self.spill.read(CHUNK_SIZE)
+                self.spill_pos += len(data)
+            if not data:
+                closing = self.spilling == "closing"
+                self.spilling = False
+                if self.spill:
+                    self.spill.close()
+                    self.spill = None
+                    self.spill_pos = 0
+                if closing:
+                    self.queue.put(None)
+            return data
+        finally:
+            self.lock.release()
+
+    def _serve(self):
+        """Consumer thread."""
+
+        while True:
+            try:
+                if self.spilling:
+                    # queued data is older than spilled one
+                    data = self.queue.get_nowait()
+                else:
+                    data = self.queue.get(True, 0.5)
+            except Queue.Empty:
+                data = self._unspill()
+                if not data:
+                    continue
+            if data is None:
+                break
+            if self.error:
+                continue
+            try:
+                self.consumer.write(data)
+            except Exception, exobj:
+                # failing consumer must not break the build
+                self.error = exobj
+                logging.getLogger(__name__).error(
+                    "log consumer %s failed: %s" % (self.consumer, exobj))
+
+    def close(self):
+        """Wait until the consumer gets all data."""
+
+        self.put(None)
+        self.thread.join()
+        try:
+            self.consumer.close()
+        except Exception, exobj:
+            self.error = self.error or exobj
+
+class LogDispatcher(object):
+    """Passes output to consumers, each one on its own thread."""
+
+    def __init__(self, consumers, maxchunks=64):
+        self.channels = [Channel(consumer, maxchunks)
+                         for consumer in consumers]
+
+    def feed(self, data):
+        """Pass chunk of output to all consumers."""
+        for channel in self.channels:
+            channel.put(data)
+
+    def close(self):
+        """Wait until all consumers get all data."""
+        for channel in self.channels:
+            channel.close()
+
+    def get_errors(self):
+        """Return list of (consumer, error) of failed consumers."""
+        return [(channel.consumer, channel.error)
+                for channel in self.channels if channel.error]
+
+class LogCapture(object):
+    """Copies command output fed by the caller to the log file.
+       Data is moved in big chunks with plain read/write system calls,
+       so there are no per-line costs. Optionally the log is compressed
+       (gzip or bz2) and last tail bytes of output are kept in memory.
+       Output is also passed to consumers through LogDispatcher. logfn
+       can be None if only consumers get the output.
+    """
+
+    def __init__(self, logfn, chunk_size=CHUNK_SIZE, compress=None, tail=0,
+                 consumers=None):
+        self.logfn = logfn
+        self.consumers = consumers or []
+        self.dispatcher = None
+        # chunk_size is tee()'s bufsize, which used to be buffering of
+        # the log file: 0 (unbuffered) and 1 (line buffered) are kept by
+        # writing every chunk as soon as it's read
+        if chunk_size <= 1:
+            chunk_size = CHUNK_SIZE
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.tail = None
+        if tail:
+            self.tail = TailBuffer(tail)
+        self.nbytes = 0
+        self.elapsed = 0.0
+        self.start = None
+        self.logfd = None
+        self.writer = None
+
+    def open(self):
+        """Open the log file."""
+        self.start = time.time()
+        if self.consumers:
+            self.dispatcher = LogDispatcher(self.consumers)
+        if not self.logfn:
+            return
+        if self.compress:
+            self.writer = CompressedWriter(self.logfn, self.compress)
+        else:
+            self.logfd = os.open(self.logfn,
+                                 os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+
+    def feed(self, data):
+        """Write chunk of output to the log."""
+        self.nbytes += len(data)
+        if self.tail:
+            self.tail.feed(data)
+        if self.dispatcher:
+            self.dispatcher.feed(data)
+        if self.writer:
+            self.writer.write(data)
+            return
+        if self.logfd is None:
+            return
+        while data:
+            data = data[os.write(self.logfd, data):]
+
+    def close(self):
+        """Close the log file and wait for consumers."""
+        if self.dispatcher:
+            dispatcher, self.dispatcher = self.dispatcher, None
+            dispatcher.close()
+            self.elapsed = time.time() - self.start
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.close()
+            self.elapsed = time.time() - self.start
+        elif self.logfd is not None:
+            os.close(self.logfd)
+            self.logfd = None
+            self.elapsed = time.time() - self.start
+
+    def throughput(self):
+        """Return capture speed in bytes per second."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.nbytes / self.elapsed
+
+    def get_tail(self):
+        """Return last bytes of output kept in memory."""
+        if self.tail:
+            return self.tail.get()
+        return ""
+
+class TeeResult(int):
+    """Exit code of tee() carrying statistics of the log capture
+       and resource usage of the command.
+       Behaves as a plain integer exit code.
+    """
+
+    def __new__(cls, status, capture=None, usage=None):
+        obj = int.__new__(cls, status)
+        obj.capture = capture
+        obj.usage = usage
+        return obj
+
+    def get_usage(self):
+        """Return ResourceUsage of the command or None."""
+        return self.usage
+
+    def get_nbytes(self):
+        """Return amount of captured output in bytes."""
+        return self.capture and self.capture.nbytes or 0
+
+    def get_throughput(self):
+        """Return capture speed in bytes per second."""
+        return self.capture and self.capture.throughput() or 0.0
+
+    def get_tail(self, lines=None):
+        """Return output tail kept in memory, optionally last lines only."""
+
+        tail = self.capture and self.capture.get_tail() or ""
+        if lines:
+            tail = "\n".join(tail.rstrip("\n").split("\n")[-lines:])
+        return tail
@@ -0,0 +1,167 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Target checkpoints.
+
+Checkpoint is a clone of the target directory (reflinked or copied,
+see templates.clone_tree) plus a manifest.Manifest of the target.
+Rollback compares the target with the manifest and restores only entries
+which differ, so its cost depends on amount of changes, not on size of
+the target.
+"""
+
+import os
+import stat
+import shutil
+import logging
+
+from scratchbox.common import SBError, run_command, shell_quote
+from scratchbox.manifest import Manifest, diff
+from scratchbox.templates import clone_tree
+
+class Checkpoint(object):
+    """Saved state of target directory."""
+
+    def __init__(self, targetdir, path):
+        self.targetdir = targetdir
+        self.path = path
+        self.tree = os.path.join(path, "tree")
+        self.manifest_fn = os.path.join(path, "manifest")
+        self.method_fn = os.path.join(path, "method")
+        self.logger = logging.getLogger(__name__)
+
+    def exists(self):
+        """Return True if checkpoint is created."""
+        return os.path.exists(self.manifest_fn)
+
+    def load(self):
+        """Load manifest. Return: (clone method, manifest)."""
+
+        manifest = Manifest(self.targetdir, self.manifest_fn)
+        manifest.load()
+        return open(self.method_fn).read().strip(), manifest
+
+    def save(self, method, manifest):
+        """Save clone method and manifest. Manifest is written last, so
+           checkpoint exists only when both are saved.
+        """
+
+        mfile = open(self.method_fn, "w")
+        try:
+            mfile.write(method + "\n")
+        finally:
+            mfile.close()
+        manifest.save(self.manifest_fn)
+
+    def scan(self):
+        """Return manifest of the target directory."""
+
+        manifest = Manifest(self.targetdir, self.manifest_fn)
+        manifest.scan()
+        return manifest
+
+    def create(self):
+        """Create checkpoint, replacing existing one."""
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.logger.debug("Creating checkpoint %s of %s" % \
+                          (self.path, self.targetdir))
+        manifest = self.scan()
+        method = clone_tree(self.targetdir, self.tree)
+        self.save(method, manifest)
+
+    def remove(self):
+        """Remove checkpoint."""
+        shutil.rmtree(self.path)
+
+    def _copy(self, method, src, dst):
+        """Restore one non-directory entry from the checkpoint."""
+
+        mode = os.lstat(src).st_mode
+        if stat.S_ISLNK(mode):
+            os.symlink(os.readlink(src), dst)
+        elif method == "reflink":
+            run_command("cp -a --reflink=always %s %s" % \
+                        (shell_quote(src), shell_quote(dst)))
+        else:
+            # restored file must not share inode with the checkpoint
+            run_command("cp -a %s %s" % (shell_quote(src), shell_quote(dst)))
+
+    def restore(self):
+        """Roll target back to the checkpoint.
+           Return: number of restored and removed entries.
+        """
+
+        if not self.exists():
+            raise SBError("No checkpoint %s" % self.path)
+        method, manifest = self.load()
+        saved = manifest.entries
+        current = self.scan().entries
+        changes = diff(saved, current)
+
+        # remove new entries, deepest first
+        for path in reversed(changes.added):
+            fname = os.path.join(self.targetdir, path)
+            if stat.S_ISDIR(current[path][0]):
+                shutil.rmtree(fname, True)
+            elif os.path.lexists(fname):
+                os.unlink(fname)
+
+        # restore changed and removed entries, parents first
+        touched_dirs = set()
+        for path in sorted(changes.removed + changes.modified):
+            mode = saved[path][0]
+            cur = current.get(path)
+            fname = os.path.join(self.targetdir, path)
+            touched_dirs.add(os.path.dirname(path))
+            if stat.S_ISDIR(mode):
+                if cur and not stat.S_ISDIR(cur[0]):
+                    os.unlink(fname)
+                if not os.path.isdir(fname):
+                    os.mkdir(fname)
+                touched_dirs.add(path)
+                continue
+
+            if cur:
+                if stat.S_ISDIR(cur[0]):
+                    shutil.rmtree(fname)
+                else:
+                    os.unlink(fname)
+            self._copy(method, os.path.join(self.tree, path), fname)
+
+        # creating and removing entries changes directory times
+        touched = list(touched_dirs)
+        touched.sort()
+        touched.reverse()
+        for path in touched:
+            shutil.copystat(os.path.join(self.tree, path),
+                            os.path.join(self.targetdir, path))
+
+        # remember inodes of restored entries to skip them next time
+        self.save(method, self.scan())
+        self.logger.debug("Rolled back %d entries of %s" % \
+                          (len(changes), self.targetdir))
+        return len(changes)
@@ -26,28 +26,42 @@ Scratchbox API. Common classes.
 """
 
 import os
-import popen2
+import errno
+import fcntl
+import select
 import signal
 import pwd
 import logging
+import subprocess
+import threading
+import md5
+import time
+import tempfile
 
-from commands import getstatusoutput
+from scratchbox.capture import LogCapture, TeeResult, CHUNK_SIZE
+from scratchbox.metrics import instrumented
+from scratchbox.accounting import ResourceUsage, accounting as usage_totals
 
 class SBError(Exception):
     """ Error generated in case of problems with Scratchbox """
     pass
 
-def run_command(command, directory = None, fatal = True):
-    """ Runs command. Chdir to directory if specified """
+class SBTimeout(SBError):
+    """ Command was killed because of timeout """
+    pass
 
-    if directory:
-        savedir = os.getcwd()
-        os.chdir(directory)
+# characters and words which require /bin/sh to run the command
+SHELL_CHARS = "|&;<>()$`\\\"'*?[]#~={}\n"
+SHELL_WORDS = (".", "cd", "source", "export", "unset", "set", "ulimit",
+               "umask", "eval", "exec", "exit", "alias", "trap", "wait",
+               "read", "if", "for", "while", "until", "case", "time")
 
-    (status, output) = getstatusoutput(command)
+def shell_quote(arg):
+    """ Quotes string to be passed to /bin/sh as a single word """
+    return "'%s'" % arg.replace("'", "'\\''")
 
-    if directory:
-        os.chdir(savedir)
+def check_status(command, status, output, fatal = True):
+    """ Converts (status, output) pair to run_command result """
 
     if status and fatal:
         raise SBError("Error running command %s\nExit code: %d\nOutput: %s"
@@ -58,16 +72,360 @@ def run_command(command, directory = None, fatal = True):
     else:
         return (status, output)
 
+def wait_status(returncode):
+    """ Converts subprocess return code to os.wait() status format """
+    if returncode < 0:
+        return -returncode
+    return returncode << 8
+
+def split_command(command):
+    """ Splits command into arguments if it can be run without shell.
+        Return: list of arguments or None if shell is required.
+    """
+
+    for char in SHELL_CHARS:
+        if char in command:
+            return None
+    args = command.split()
+    if not args or args[0] in SHELL_WORDS:
+        return None
+    return args
+
+def _child_setup():
+    """ Runs in child before exec: starts new process group and closes
+        inherited descriptors. Only /proc/self/fd entries are checked,
+        which is much cheaper than close_fds on hosts with high fd limit.
+        Close-on-exec descriptors (including subprocess error pipe) are
+        left alone.
+    """
+
+    os.setsid()
+    for name in os.listdir("/proc/self/fd"):
+        fdn = int(name)
+        if fdn < 3:
+            continue
+        try:
+            if not fcntl.fcntl(fdn, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                os.close(fdn)
+        except (IOError, OSError):
+            pass
+
+# close_fds of subprocess is used when /proc is not available
+CLOSE_FDS = not os.path.isdir("/proc/self/fd")
+
+class Process(object):
+    """Child process running in its own process group.
+
+       Working directory is set for the child only, so processes can be
+       started from several threads at once. Commands without shell syntax
+       are executed directly, without /bin/sh. On timeout the whole group
+       gets SIGTERM, and SIGKILL after grace period. Output is read for
+       drain seconds more after SIGKILL: descendants which left the group
+       can keep the pipe open forever. The child is reaped with wait4(),
+       so its resource usage is available as usage attribute after it
+       exits.
+    """
+
+    grace = 5
+    drain = 1
+
+    def __init__(self, command, directory=None, timeout=None, stdin=None,
+                 stdout=subprocess.PIPE):
+        self.command = command
+        self.timed_out = False
+        self.killed = False
+        self.deadline = None
+        self.usage = None
+        self.start = time.time()
+        if timeout:
+            self.deadline = time.time() + timeout
+        args = split_command(command)
+        self.proc = subprocess.Popen(args or command, shell=args is None,
+                                     cwd=directory, stdin=stdin,
+                                     stdout=stdout,
+                                     stderr=subprocess.STDOUT,
+                                     close_fds=CLOSE_FDS,
+                                     preexec_fn=CLOSE_FDS and os.setsid \
+                                                or _child_setup)
+        self.pid = self.proc.pid
+        self.stdin = self.proc.stdin
+        self.stdout = self.proc.stdout
+
+    def kill(self, sig=signal.SIGTERM):
+        """Send signal to the process group."""
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            pass
+
+    def expire(self):
+        """Handle reached deadline.
+           Return: False if output shouldn't be read anymore.
+        """
+
+        if not self.timed_out:
+            self.timed_out = True
+            self.kill(signal.SIGTERM)
+            self.deadline = time.time() + self.grace
+        elif not self.killed:
+            self.killed = True
+            self.kill(signal.SIGKILL)
+            self.deadline = time.time() + self.drain
+        else:
+            self.deadline = None
+            return False
+        return True
+
+    def pump(self, consumer, chunk_size=CHUNK_SIZE):
+        """Pass output to consumer(data) in chunks until EOF."""
+
+        fileno = self.stdout.fileno()
+        while True:
+            if self.deadline:
+                timeout = self.deadline - time.time()
+                if timeout <= 0:
+                    if not self.expire():
+                        break
+                    continue
+                try:
+                    if not select.select([fileno], [], [], timeout)[0]:
+                        continue
+                except select.error, exobj:
+                    if exobj.args[0] == errno.EINTR:
+                        continue
+                    raise
+            data = os.read(fileno, chunk_size)
+            if not data:
+                break
+            consumer(data)
+        self.stdout.close()
+
+    def _reap(self, options=0):
+        """Collect exit status and resource usage of the child.
+           Return: exit status in os.wait() format or None.
+        """
+
+        if self.proc.returncode is not None:
+            return wait_status(self.proc.returncode)
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.pid, options)
+            except OSError, exobj:
+                if exobj.errno == errno.EINTR:
+                    continue
+                if exobj.errno == errno.ECHILD:
+                    # reaped by somebody else, usage is lost
+                    return wait_status(self.proc.wait())
+                raise
+            break
+        if pid == 0:
+            return None
+        self.usage = ResourceUsage(rusage, time.time() - self.start)
+        # let subprocess know the child is gone
+        if os.WIFSIGNALED(status):
+            self.proc.returncode = -os.WTERMSIG(status)
+        else:
+            self.proc.returncode = os.WEXITSTATUS(status)
+        return wait_status(self.proc.returncode)
+
+    def poll(self):
+        """Check if process has exited.
+           Return: exit status in os.wait() format or None.
+        """
+        return self._reap(os.WNOHANG)
+
+    def wait(self):
+        """Wait for the process to exit.
+           Return: exit status in os.wait() format.
+        """
+
+        while self.deadline:
+            if self._reap(os.WNOHANG) is not None:
+                break
+            if time.time() >= self.deadline:
+                self.expire()
+            else:
+                time.sleep(0.05)
+        return self._reap()
+
+class CommandOutput(str):
+    """Output of run() carrying exit status and resource usage
+       of the command. Behaves as a plain string.
+    """
+
+    def __new__(cls, output, status=0, usage=None):
+        obj = str.__new__(cls, output)
+        obj.status = status
+        obj.usage = usage
+        return obj
+
+    def get_usage(self):
+        """Return ResourceUsage of the command or None."""
+        return self.usage
+
+def execute(command, directory=None, timeout=None, accounting=False):
+    """ Runs command and collects its output. Raises SBTimeout on timeout.
+        If accounting is set, output is CommandOutput with resource usage.
+        Return: (status, output) like commands.getstatusoutput does.
+    """
+
+    try:
+        proc = Process(command, directory, timeout)
+    except OSError, exobj:
+        if exobj.errno == errno.ENOENT and \
+           (not directory or os.path.isdir(directory)):
+            # the same as shell does for missing command
+            output = "%s: %s" % (command.split()[0], exobj.strerror)
+            if accounting:
+                output = CommandOutput(output, 127 << 8)
+            return (127 << 8, output)
+        raise
+    output = []
+    proc.pump(output.append)
+    status = proc.wait()
+    output = "".join(output)
+    if proc.timed_out:
+        raise SBTimeout("Timeout running command %s\nOutput: %s" % \
+                        (command, output))
+    if output[-1:] == "\n":
+        output = output[:-1]
+    if accounting:
+        output = CommandOutput(output, status, proc.usage)
+    return (status, output)
+
+def run_command(command, directory = None, fatal = True, timeout = None,
+                accounting = False):
+    """ Runs command in directory if specified """
+
+    (status, output) = execute(command, directory, timeout, accounting)
+    return check_status(command, status, output, fatal)
+
+def make_marker():
+    """ Returns unique string separating outputs of framed commands """
+    return "__sb_status_%s__" % \
+           md5.md5("%d.%f" % (os.getpid(), time.time())).hexdigest()
+
+def frame_command(command, marker, directory=None):
+    """ Returns shell code running command with stdin closed and printing
+        marker line with exit code after its output. Exit code is also
+        left in $sb_status variable.
+    """
+
+    script = "eval %s" % shell_quote(command)
+    if directory:
+        script = "cd %s && %s" % (shell_quote(directory), script)
+    return '(%s) </dev/null 2>&1; sb_status=$?; echo "%s $sb_status"\n' % \
+           (script, marker)
+
+def parse_framed(data, marker):
+    """ Splits output of framed commands.
+        Return: list of (status, output) pairs and unparsed rest of data.
+    """
+
+    results = []
+    while True:
+        pos = data.find(marker)
+        if pos < 0:
+            break
+        end = data.find("\n", pos)
+        if end < 0:
+            break
+        code = int(data[pos + len(marker):end])
+        output = data[:pos]
+        if output[-1:] == "\n":
+            output = output[:-1]
+        # the same status format as commands.getstatusoutput
+        results.append((code << 8, output))
+        data = data[end + 1:]
+    return (results, data)
+
+class CommandServer(object):
+    """Persistent shell running inside scratchbox.
+
+       Commands are written to the shell's stdin one by one. Output of
+       every command is followed by a marker line carrying its exit code,
+       so the shell is started only once for any number of commands.
+    """
+
+    def __init__(self, exe, options=""):
+        self.command = "%s %s /bin/sh -s" % (exe, options)
+        self.marker = make_marker()
+        self.pipe = None
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        """Start the shell."""
+
+        self.logger.debug("starting command server: %s" % self.command)
+        self.pipe = Process(self.command, stdin=subprocess.PIPE)
+
+    def stop(self):
+        """Stop the shell."""
+
+        if not self.pipe:
+            return
+        self.logger.debug("stopping command server: %s" % self.command)
+        try:
+            self.pipe.stdin.write("exit 0\n")
+            self.pipe.stdin.close()
+        except IOError:
+            pass
+        self.pipe.stdout.close()
+        self.pipe.kill()
+        self.pipe.wait()
+        self.pipe = None
+
+    def execute(self, command, directory=None):
+        """Run command in the shell.
+           Return: (status, output) like commands.getstatusoutput does.
+        """
+
+        self.lock.acquire()
+        try:
+            if not self.pipe:
+                raise SBError("Command server is not running")
+            try:
+                self.pipe.stdin.write(frame_command(command, self.marker,
+                                                    directory))
+                self.pipe.stdin.flush()
+            except IOError, exobj:
+                raise SBError("Command server died: %s" % exobj)
+            return self._read_result()
+        finally:
+            self.lock.release()
+
+    def _read_result(self):
+        """Read command output up to the status marker."""
+
+        fileno = self.pipe.stdout.fileno()
+        data = ""
+        start = 0
+        while True:
+            chunk = os.read(fileno, 65536)
+            if not chunk:
+                raise SBError("Command server died. Output: %s" % data)
+            data += chunk
+            pos = data.find(self.marker, start)
+            if pos >= 0 and data.find("\n", pos) >= 0:
+                return parse_framed(data, self.marker)[0][0]
+            # marker can be split between chunks
+            start = max(0, len(data) - len(self.marker))
+
 class Scratchbox(object):
     """Base class."""
 
     MODE_DEVEL = "devel"
     MODE_EMUL = "emulation"
 
+    # can commands run in different targets at the same time
+    parallel_targets = False
+
     def __init__(self, target_name=None):
         self.user = pwd.getpwuid(os.geteuid())[0]
         self.exe = None
         self.target_name = target_name
+        self.server = None
         self.logger = logging.getLogger(__name__)
         if target_name:
             self.select(target_name)
@@ -83,43 +441,154 @@ class Scratchbox(object):
         """Send signal to all sb processes."""
         pass
 
-    def run(self, command, directory=None, exe=None, fatal=True):
-        """Run command inside scratchbox."""
+    def start_server(self, options=""):
+        """Start persistent shell inside scratchbox.
+           Following run() calls are executed by this shell instead of
+           starting scratchbox for every command.
+        """
+        if self.server:
+            return
+        self.server = CommandServer(self.exe, options)
+        self.server.start()
+
+    def stop_server(self):
+        """Stop persistent shell."""
+        if self.server:
+            self.server.stop()
+            self.server = None
+
+    @instrumented("run")
+    def run(self, command, directory=None, exe=None, fatal=True,
+            timeout=None, accounting=False):
+        """Run command inside scratchbox.
+           Raises SBTimeout if command doesn't finish in timeout seconds.
+           If accounting is set, output is returned as CommandOutput
+           with resource usage of the command. Such commands and commands
+           with timeout are not run by the command server, as they need
+           a process of their own.
+        """
+        if accounting:
+            if not exe:
+                exe = self.exe
+            self.logger.debug("running command: %s %s" % (exe, command))
+            (status, output) = execute("%s %s" % (exe, command), directory,
+                                       timeout, accounting=True)
+            usage_totals.record("run", self.target_name, output.usage)
+            return check_status(command, status, output, fatal)
+        # server shell cds to directory, it has to be visible inside
+        sb_dir = directory and self.get_sb_path(os.path.abspath(directory))
+        if self.server and (not exe or exe == self.exe) and not timeout \
+           and (sb_dir or not directory):
+            self.logger.debug("running command on server: %s" % command)
+            (status, output) = self.server.execute(command, sb_dir)
+            return check_status(command, status, output, fatal)
+        return self._run_direct(command, directory, exe, fatal, timeout)
+
+    def _run_direct(self, command, directory=None, exe=None, fatal=True,
+                    timeout=None):
+        """Run scratchbox executable with command line, never through
+           the command server. Used for control of the sandbox itself
+           (scratchbox options, sb-conf), which is not a shell command
+           and must not run inside the server's session.
+        """
         if not exe:
             exe = self.exe
         self.logger.debug("running command: %s %s" % (exe, command))
-        return run_command("%s %s" % (exe, command), directory, fatal=fatal)
+        # output carries resource usage of the command for metrics
+        return run_command("%s %s" % (exe, command), directory, fatal=fatal,
+                           timeout=timeout, accounting=True)
+
+    @instrumented("run_many")
+    def run_many(self, commands, directory=None, stop_on_error=False):
+        """Run list of commands inside single scratchbox invocation.
+           If stop_on_error is set, commands after the first failed one
+           are not run.
+           Return: list of (status, output) pairs, one per command run.
+        """
+
+        sb_dir = directory and self.get_sb_path(os.path.abspath(directory))
+        if self.server and (sb_dir or not directory):
+            results = []
+            for command in commands:
+                results.append(self.server.execute(command, sb_dir))
+                if stop_on_error and results[-1][0]:
+                    break
+            return results
+
+        marker = make_marker()
+        script = tempfile.NamedTemporaryFile(prefix="sb-run-many-")
+        try:
+            for command in commands:
+                script.write(frame_command(command, marker))
+                if stop_on_error:
+                    script.write('[ "$sb_status" -eq 0 ] || exit 0\n')
+            script.flush()
+            self.logger.debug("running %d commands: %s" % \
+                              (len(commands), commands))
+            (status, output) = run_command("%s /bin/sh -s < %s" % \
+                                           (self.exe, script.name),
+                                           directory, fatal=False)
+        finally:
+            script.close()
+
+        # run_command strips the last newline
+        results, rest = parse_framed(output + "\n", marker)
+        if len(results) < len(commands) and \
+           not (stop_on_error and results and results[-1][0]):
+            raise SBError("Batch of commands was interrupted\n"
+                          "Exit code: %d\nOutput: %s" % (status, rest))
+        return results
 
     def extract_rootstrap(self, rootstrap):
         """Extracts given rootstrap into target."""
         raise NotImplementedError
 
-    def _tee(self, command, logfn, bufsize=0):
+    def get_tee_command(self, command, mode, superuser=False):
+        """Returns scratchbox arguments used by tee() to run command."""
+        raise NotImplementedError
+
+    @instrumented("tee")
+    def _tee(self, command, logfn, bufsize=0, compress=None, tail=0,
+             timeout=None, consumers=None):
         """Run command on pipe. redirect stdout and stderr to log file.
-            Return: exit code of the command.
+            bufsize is buffering of the log as for open(): output is
+            written as soon as it's read, bufsize > 1 also limits amount
+            read from the pipe at once.
+            compress is "gzip" or "bz2" to compress the log on the fly.
+            tail is amount of last output bytes kept in memory.
+            timeout is in seconds, process group is killed after it.
+            consumers is list of capture.Consumer objects getting output
+            as it comes, logfn can be None if they are given.
+            Return: exit code of the command as TeeResult, which also
+            carries resource usage of the command.
         """
 
         self.logger.debug("_tee: running %s %s log: %s" % \
                 (self.exe, command, logfn))
-        pipe = popen2.Popen4("%s %s </dev/null" % (self.exe, command))
-        logfd = open(logfn, "w", bufsize)
-
-        pipe.tochild.close()
-
-        while True:
-            line = pipe.fromchild.readline()
-            if not line:
-                break
-            logfd.write(line)
-
-        pipe.fromchild.close()
-        logfd.close()
-
-        status = pipe.wait()
+        devnull = open(os.devnull)
+        try:
+            proc = Process("%s %s" % (self.exe, command), timeout=timeout,
+                           stdin=devnull)
+        finally:
+            devnull.close()
+
+        capture = LogCapture(logfn, bufsize, compress, tail, consumers)
+        capture.open()
+        try:
+            proc.pump(capture.feed, capture.chunk_size)
+        finally:
+            capture.close()
+        self.logger.debug("_tee: captured %d bytes in %.2f s (%.0f bytes/s)" \
+                % (capture.nbytes, capture.elapsed, capture.throughput()))
+
+        status = proc.wait()
+        usage_totals.record("tee", self.target_name, proc.usage)
+        if proc.timed_out:
+            self.logger.error("_tee: timeout running %s" % command)
         if os.WIFEXITED(status):
-            return os.WEXITSTATUS(status)
+            return TeeResult(os.WEXITSTATUS(status), capture, proc.usage)
 
-        return -1
+        return TeeResult(-1, capture, proc.usage)
 
     def select(self, tname):
         """Select target."""
@@ -127,12 +596,44 @@ class Scratchbox(object):
 
     def release(self):
         """Release acquired resources."""
-        pass
+        self.stop_server()
 
     def reset(self, tname):
         """Reset target and put required libraries in place."""
         pass
 
+    def get_checkpoint(self, name, target_name=None):
+        """Returns Checkpoint object of the target."""
+        from scratchbox.checkpoint import Checkpoint
+        if not target_name:
+            target_name = self.target_name
+        return Checkpoint(self.get_targetdir(target_name),
+                          os.path.join(self.get_basedir(), ".sb-checkpoints",
+                                       target_name, name))
+
+    def checkpoint(self, name):
+        """Save state of the current target under given name."""
+        self.get_checkpoint(name).create()
+
+    def rollback(self, name):
+        """Restore state of the current target saved by checkpoint()."""
+        return self.get_checkpoint(name).restore()
+
+    def get_manifest(self, name="current", target_name=None, hashes=False):
+        """Returns Manifest of the target saved under given name.
+           It's loaded if it was saved already; update() brings it in sync
+           with the target.
+        """
+        from scratchbox.manifest import Manifest
+        if not target_name:
+            target_name = self.target_name
+        manifest = Manifest(self.get_targetdir(target_name),
+                            os.path.join(self.get_basedir(), ".sb-manifests",
+                                         target_name, name), hashes)
+        if os.path.exists(manifest.path):
+            manifest.load()
+        return manifest
+
     def get_basedir(self):
         """Returns absolute path to scratchbox base directory."""
         raise NotImplementedError
@@ -165,6 +666,34 @@ class Scratchbox(object):
         """Installs into target Scratchbox extra file."""
         pass
 
-    def pull_dir(self, sb_dir, host_dir):
-        """Move directory from scratchbox env to specified host folder."""
-        pass
+    def get_host_path(self, sb_path):
+        """Returns host path of the path inside scratchbox."""
+        raise NotImplementedError
+
+    def get_sb_path(self, host_path):
+        """Returns path inside scratchbox of absolute host path or None
+           if it's not visible there. Host paths are the same inside
+           scratchbox unless it's a chroot.
+        """
+        return host_path
+
+    def pull_dir(self, sb_dir, host_dir, verify=False, delete=False,
+                 link=False):
+        """Copy directory from scratchbox env to specified host folder.
+           Only new and changed files are transferred, see
+           sync.sync_tree() for the meaning of options.
+           Return: SyncStats.
+        """
+        from scratchbox.sync import sync_tree
+        return sync_tree(self.get_host_path(sb_dir), host_dir, verify,
+                         delete, link)
+
+    def push_dir(self, host_dir, sb_dir, verify=False, delete=False,
+                 link=False):
+        """Copy host directory into scratchbox env, transferring only
+           new and changed files.
+           Return: SyncStats.
+        """
+        from scratchbox.sync import sync_tree
+        return sync_tree(host_dir, self.get_host_path(sb_dir), verify,
+                         delete, link)
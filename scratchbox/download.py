@@ -0,0 +1,415 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Downloading of rootstrap tarballs.
+"""
+
+import os
+import re
+import errno
+import zlib
+import threading
+import urllib2
+import logging
+import Queue
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from tarfile import TarFile
+
+from scratchbox.common import SBError
+
+CHUNK_SIZE = 65536
+
+class GunzipStream(object):
+    """Read-only file object returning gunzipped data of HTTP response.
+
+       Fetching and decompression run on a separate thread, the reader
+       gets decompressed chunks through a bounded queue.
+    """
+
+    def __init__(self, response, maxchunks=64):
+        self.response = response
+        self.queue = Queue.Queue(maxchunks)
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+        self.nbytes = 0
+        self.thread = threading.Thread(target=self._fetch)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _put(self, item):
+        """Put item to the queue unless reader is closed."""
+
+        while not self.closed:
+            try:
+                self.queue.put(item, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _fetch(self):
+        """Fetching thread."""
+
+        # 16 + MAX_WBITS makes zlib expect gzip header
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            while True:
+                data = self.response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.nbytes += len(data)
+                # limit size of decompressed chunks
+                while data:
+                    if not self._put(decomp.decompress(data, CHUNK_SIZE)):
+                        return
+                    data = decomp.unconsumed_tail
+            self._put(decomp.flush())
+            self._put(None)
+        except Exception, exobj:
+            self._put(exobj)
+
+    def read(self, size=-1):
+        """Read up to size bytes."""
+
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.buf):
+                if self.eof:
+                    break
+                item = self.queue.get()
+                if item is None:
+                    self.eof = True
+                elif isinstance(item, Exception):
+                    self.eof = True
+                    raise SBError("Download failed: %s" % item)
+                else:
+                    self.buf = item
+                    self.pos = 0
+                continue
+            if size < 0:
+                data = self.buf[self.pos:]
+            else:
+                data = self.buf[self.pos:self.pos + size]
+                size -= len(data)
+            self.pos += len(data)
+            parts.append(data)
+        return "".join(parts)
+
+    def close(self):
+        """Stop fetching."""
+        self.closed = True
+        self.response.close()
+
+def stream_extract(urls, path):
+    """Download gzipped tarball and extract it into path on the fly.
+       No temporary tarball is created. urls is URL or list of mirror
+       URLs, the first one which answers is used.
+       Return: amount of downloaded bytes.
+    """
+
+    logger = logging.getLogger(__name__)
+    if isinstance(urls, basestring):
+        urls = [urls]
+    errors = []
+    for url in urls:
+        logger.debug("Streaming %s into %s" % (url, path))
+        try:
+            response = urllib2.urlopen(url)
+            break
+        except (urllib2.URLError, IOError), exobj:
+            errors.append("%s: %s" % (url, exobj))
+    else:
+        raise SBError("Can't fetch %s" % "; ".join(errors))
+
+    stream = GunzipStream(response)
+    try:
+        tarfile = TarFile.open(fileobj=stream, mode='r|', bufsize=CHUNK_SIZE)
+        for member in tarfile:
+            tarfile.extract(member, path=path)
+        tarfile.close()
+    finally:
+        stream.close()
+    return stream.nbytes
+
+class HeadRequest(urllib2.Request):
+    """HTTP HEAD request."""
+
+    def get_method(self):
+        return "HEAD"
+
+class SegmentedDownload(object):
+    """Download of one file over several connections.
+
+       The file is split into segments fetched in parallel with HTTP
+       Range requests, each one from the first mirror which works.
+       Data goes to <path>.part, numbers of finished segments are kept in
+       <path>.state, so download interrupted by a crash continues from
+       where it stopped. Servers without Range support are read over
+       single connection.
+    """
+
+    segment_size = 4 << 20
+    retries = 3
+    timeout = 60
+
+    def __init__(self, urls, path, connections=4):
+        if isinstance(urls, basestring):
+            urls = [urls]
+        self.urls = list(urls)
+        self.path = path
+        self.connections = max(1, connections)
+        self.partname = path + ".part"
+        self.statename = path + ".state"
+        self.size = None
+        self.validator = None
+        self.ranges = False
+        self.done = set()
+        self.failed = {}
+        # amount of bytes downloaded by this process
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def probe(self):
+        """Get size and validator of the file from the first mirror
+           which answers.
+        """
+
+        errors = []
+        for url in self.urls:
+            try:
+                response = urllib2.urlopen(HeadRequest(url),
+                                           timeout=self.timeout)
+            except (urllib2.URLError, IOError), exobj:
+                errors.append("%s: %s" % (url, exobj))
+                continue
+            info = response.info()
+            response.close()
+            length = info.getheader("Content-Length")
+            if length is not None:
+                self.size = int(length)
+            self.validator = info.getheader("ETag") or \
+                             info.getheader("Last-Modified")
+            self.ranges = info.getheader("Accept-Ranges") == "bytes" and \
+                          self.size is not None
+            # serve the mirror which answered first
+            self.urls.remove(url)
+            self.urls.insert(0, url)
+            return
+        raise SBError("Can't fetch %s" % "; ".join(errors))
+
+    def load_state(self):
+        """Continue previous download of the same file if possible."""
+
+        try:
+            state = json.loads(open(self.statename).read())
+        except (IOError, ValueError):
+            return
+        if state.get("size") == self.size and \
+           state.get("validator") == self.validator and \
+           os.path.exists(self.partname):
+            self.done = set(state.get("done", ()))
+            self.logger.debug("Resuming download of %s, %d segments done" % \
+                              (self.path, len(self.done)))
+
+    def save_state(self):
+        """Write list of finished segments atomically."""
+
+        tmpname = "%s.%d" % (self.statename, os.getpid())
+        sfile = open(tmpname, "w")
+        try:
+            sfile.write(json.dumps({"size": self.size,
+                                    "validator": self.validator,
+                                    "done": sorted(self.done)}))
+        finally:
+            sfile.close()
+        os.rename(tmpname, self.statename)
+
+    def fetch_segment(self, index):
+        """Download one segment trying mirrors in order. Connection
+           closed in the middle of the segment is continued from where
+           it stopped.
+        """
+
+        start = index * self.segment_size
+        end = min(start + self.segment_size, self.size) - 1
+        offset = start
+        errors = []
+        for attempt in range(self.retries):
+            for url in self.urls:
+                while self.failed.get(url, 0) < self.retries:
+                    try:
+                        reached = self._fetch_range(url, offset, end)
+                        if reached > end:
+                            return
+                        if reached == offset:
+                            raise SBError("Connection closed with %d bytes "
+                                          "left" % (end - offset + 1))
+                        offset = reached
+                    except (urllib2.URLError, IOError, SBError), exobj:
+                        self.lock.acquire()
+                        self.failed[url] = self.failed.get(url, 0) + 1
+                        self.lock.release()
+                        errors.append("%s: %s" % (url, exobj))
+                        self.logger.warning("Segment %d of %s failed: %s" \
+                                            % (index, url, exobj))
+                        break
+        raise SBError("Can't download bytes %d-%d of %s: %s" % \
+                      (start, end, self.path, "; ".join(errors[-3:])))
+
+    def _fetch_range(self, url, start, end):
+        """Write bytes start..end of url to the part file.
+           Return: offset following the last written byte.
+        """
+
+        request = urllib2.Request(url)
+        request.add_header("Range", "bytes=%d-%d" % (start, end))
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            crange = response.info().getheader("Content-Range") or ""
+            match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", crange)
+            if response.getcode() != 206 or not match or \
+               int(match.group(1)) != start or int(match.group(2)) != end or \
+               match.group(3) not in ("*", str(self.size)):
+                raise SBError("Mirror doesn't serve range %d-%d, "
+                              "got %s" % (start, end, crange or "whole file"))
+            outfd = os.open(self.partname, os.O_WRONLY)
+            offset = start
+            try:
+                os.lseek(outfd, start, os.SEEK_SET)
+                while offset <= end:
+                    data = response.read(min(end - offset + 1, CHUNK_SIZE))
+                    if not data:
+                        break
+                    offset += len(data)
+                    while data:
+                        data = data[os.write(outfd, data):]
+            finally:
+                os.close(outfd)
+                self.lock.acquire()
+                self.nbytes += offset - start
+                self.lock.release()
+        finally:
+            response.close()
+        return offset
+
+    def _worker(self, queue, errors):
+        """Thread fetching segments from the queue."""
+
+        while not errors:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.fetch_segment(index)
+            except SBError, exobj:
+                errors.append(exobj)
+                return
+            self.lock.acquire()
+            try:
+                self.done.add(index)
+                self.save_state()
+            finally:
+                self.lock.release()
+
+    def _fetch_whole(self):
+        """Download the file over single connection."""
+
+        errors = []
+        for url in self.urls:
+            try:
+                response = urllib2.urlopen(url, timeout=self.timeout)
+            except (urllib2.URLError, IOError), exobj:
+                errors.append("%s: %s" % (url, exobj))
+                continue
+            try:
+                outfile = open(self.partname, "wb")
+                try:
+                    while True:
+                        data = response.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        self.nbytes += len(data)
+                        outfile.write(data)
+                finally:
+                    outfile.close()
+                return
+            finally:
+                response.close()
+        raise SBError("Can't fetch %s" % "; ".join(errors))
+
+    def run(self):
+        """Download the file.
+           Return: path to the downloaded file.
+        """
+
+        self.probe()
+        if not self.ranges:
+            self.logger.debug("No Range support, fetching %s at once" % \
+                              self.urls[0])
+            self._fetch_whole()
+            os.rename(self.partname, self.path)
+            return self.path
+
+        self.load_state()
+        if not self.done:
+            partfile = open(self.partname, "wb")
+            partfile.truncate(self.size)
+            partfile.close()
+        count = (self.size + self.segment_size - 1) / self.segment_size
+        queue = Queue.Queue()
+        for index in range(count):
+            if index not in self.done:
+                queue.put(index)
+        self.logger.debug("Fetching %d of %d segments of %s over %d "
+                          "connections" % (queue.qsize(), count, self.path,
+                                           self.connections))
+        errors = []
+        threads = [threading.Thread(target=self._worker,
+                                    args=(queue, errors))
+                   for _ in range(min(self.connections, queue.qsize()))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # state is kept, next run continues the download
+            raise errors[0]
+
+        os.rename(self.partname, self.path)
+        try:
+            os.unlink(self.statename)
+        except OSError, exobj:
+            if exobj.errno != errno.ENOENT:
+                raise
+        return self.path
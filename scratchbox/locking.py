@@ -0,0 +1,103 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. File locks.
+"""
+
+import os
+import errno
+import fcntl
+
+from scratchbox.common import SBError
+
+class FileLock(object):
+    """Advisory lock on a file taken with flock().
+
+       Shared locks are held by users of a resource, exclusive lock by
+       the process which removes it. Creation is serialized by separate
+       exclusive lock: converting shared lock to exclusive one isn't
+       atomic and waits until all other users release the lock. The kernel
+       drops locks of dead processes, and waiters wake up as soon as the
+       lock is free.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.exclusive = None
+
+    def acquire(self, exclusive=False, blocking=True):
+        """Take the lock or convert already taken one.
+           Return: False if blocking is not set and lock is busy.
+        """
+
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+            # don't let children (sb2, tar, ...) inherit the lock
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+            fcntl.fcntl(self.fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+        operation = fcntl.LOCK_SH
+        if exclusive:
+            operation = fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        while True:
+            try:
+                fcntl.flock(self.fd, operation)
+                break
+            except IOError, exobj:
+                if exobj.errno == errno.EINTR:
+                    continue
+                if exobj.errno in (errno.EAGAIN, errno.EACCES) \
+                   and not blocking:
+                    if self.exclusive is None:
+                        self.release()
+                    return False
+                raise SBError("Can't lock %s: %s" % (self.path, exobj))
+        self.exclusive = exclusive
+        return True
+
+    def release(self):
+        """Release the lock."""
+
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.exclusive = None
+
+    def is_locked(self):
+        """Return True if the lock is held by this object."""
+        return self.exclusive is not None
+
+def is_busy(path):
+    """Return True if anybody holds a lock on the file."""
+
+    if not os.path.exists(path):
+        return False
+    lock = FileLock(path)
+    if lock.acquire(exclusive=True, blocking=False):
+        lock.release()
+        return False
+    return True
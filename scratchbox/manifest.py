@@ -0,0 +1,287 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Target manifest index.
+
+Manifest keeps mode, size, mtime, inode and optionally md5 of every
+entry of the target tree. update() stats all directories but lists and
+stats contents only of directories whose mtime has changed, so it's
+cheap for big targets with few changes. Files modified in place don't
+change mtime of their directory; update(verify=True) stats every entry
+to catch them as well.
+
+On disk manifest is a header followed by struct packed records sorted by
+path. Each path is stored as length of the prefix shared with the
+previous path and the rest of it.
+"""
+
+import os
+import stat
+import struct
+import md5
+
+from scratchbox.common import SBError
+
+MAGIC = "SBMF"
+VERSION = 1
+HEADER = struct.Struct("<4sHI")
+# shared prefix, suffix length, mode, size, mtime, inode, md5
+RECORD = struct.Struct("<HHIQdQ16s")
+NO_DIGEST = "\0" * 16
+
+def file_md5(path):
+    """Return raw md5 digest of file contents."""
+
+    digest = md5.md5()
+    ifile = open(path, "rb")
+    try:
+        while True:
+            data = ifile.read(65536)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        ifile.close()
+    return digest.digest()
+
+def _join(parent, name):
+    """Join relative paths, "" is the root."""
+    if parent:
+        return parent + "/" + name
+    return name
+
+class ManifestDiff(object):
+    """Difference between two manifests: sorted lists of paths."""
+
+    def __init__(self, added, removed, modified):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.modified)
+
+def diff(old, new):
+    """Compare dictionaries path -> entry of two manifests.
+       Entries are modified if their mode, size, mtime or inode differ,
+       or if both have content digests and the digests differ.
+       Return: ManifestDiff.
+    """
+
+    added = [path for path in new if path not in old]
+    removed = [path for path in old if path not in new]
+    modified = []
+    for path, entry in new.iteritems():
+        oentry = old.get(path)
+        if oentry is None or oentry == entry:
+            continue
+        if oentry[:4] != entry[:4] or \
+           (oentry[4] and entry[4] and oentry[4] != entry[4]):
+            modified.append(path)
+    added.sort()
+    removed.sort()
+    modified.sort()
+    return ManifestDiff(added, removed, modified)
+
+class Manifest(object):
+    """Index of the directory tree root.
+       entries: dictionary relative path -> (mode, size, mtime, inode,
+       md5 or None). The root itself has empty path.
+    """
+
+    def __init__(self, root, path=None, hashes=False):
+        self.root = root
+        self.path = path
+        self.hashes = hashes
+        self.entries = {}
+        self.children = None
+
+    def copy(self):
+        """Return snapshot of the manifest."""
+
+        result = Manifest(self.root, None, self.hashes)
+        result.entries = self.entries.copy()
+        return result
+
+    def _get_children(self):
+        """Return dictionary directory -> set of names in it."""
+
+        if self.children is None:
+            self.children = {}
+            for path in self.entries:
+                if path:
+                    parent, _, name = path.rpartition("/")
+                    self.children.setdefault(parent, set()).add(name)
+        return self.children
+
+    def _remove(self, path):
+        """Drop entry and everything below it."""
+
+        children = self._get_children()
+        for name in children.pop(path, ()):
+            self._remove(_join(path, name))
+        del self.entries[path]
+
+    def _make_entry(self, fname, fstat, old):
+        """Return entry of the file, reusing digest if it's unchanged."""
+
+        digest = None
+        if self.hashes and stat.S_ISREG(fstat.st_mode):
+            if old and old[4] and old[1:4] == (fstat.st_size,
+                                               fstat.st_mtime, fstat.st_ino):
+                digest = old[4]
+            else:
+                try:
+                    digest = file_md5(fname)
+                except IOError:
+                    pass
+        return (fstat.st_mode, fstat.st_size, fstat.st_mtime, fstat.st_ino,
+                digest)
+
+    def update(self, verify=False):
+        """Bring the manifest in sync with the tree.
+           Return: number of added, removed and changed entries.
+        """
+
+        entries = self.entries
+        children = self._get_children()
+        changes = 0
+        stack = [""]
+        while stack:
+            path = stack.pop()
+            fname = os.path.join(self.root, path)
+            old = entries.get(path)
+            try:
+                fstat = os.lstat(fname)
+            except OSError:
+                if old:
+                    self._remove(path)
+                    changes += 1
+                continue
+            entry = self._make_entry(fname, fstat, old)
+            if entry != old:
+                changes += 1
+                entries[path] = entry
+            if not stat.S_ISDIR(fstat.st_mode):
+                if path in children:
+                    # directory was replaced by a file
+                    for name in children.pop(path):
+                        self._remove(_join(path, name))
+                continue
+
+            if old is None or old[0] != entry[0] or old[2:4] != entry[2:4]:
+                # contents of the directory changed, list it again
+                names = set(os.listdir(fname))
+                for name in children.get(path, set()) - names:
+                    self._remove(_join(path, name))
+                    changes += 1
+                children[path] = names
+                stack.extend([_join(path, name) for name in names])
+            else:
+                for name in children.get(path, ()):
+                    cpath = _join(path, name)
+                    if verify or stat.S_ISDIR(entries[cpath][0]):
+                        stack.append(cpath)
+        return changes
+
+    def scan(self):
+        """Build the manifest from scratch."""
+
+        self.entries = {}
+        self.children = None
+        return self.update()
+
+    def diff(self, old):
+        """Return ManifestDiff of changes since old manifest."""
+        return diff(old.entries, self.entries)
+
+    def save(self, path=None):
+        """Write the manifest atomically."""
+
+        path = path or self.path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        paths = self.entries.keys()
+        paths.sort()
+        records = [HEADER.pack(MAGIC, VERSION, len(paths))]
+        prev = ""
+        prefix = ""
+        for fpath in paths:
+            mode, size, mtime, ino, digest = self.entries[fpath]
+            # siblings share the directory, the common case is cheap
+            if not fpath.startswith(prefix):
+                prefix = os.path.commonprefix([prev, fpath])
+            shared = min(len(prefix), 0xffff)
+            suffix = fpath[shared:]
+            if len(suffix) > 0xffff:
+                raise SBError("Path is too long: %s" % fpath)
+            records.append(RECORD.pack(shared, len(suffix), mode, size, mtime,
+                                       ino, digest or NO_DIGEST))
+            records.append(suffix)
+            prev = fpath
+            prefix = fpath[:fpath.rfind("/") + 1]
+
+        tmpname = "%s.%d" % (path, os.getpid())
+        mfile = open(tmpname, "wb")
+        try:
+            mfile.write("".join(records))
+        finally:
+            mfile.close()
+        os.rename(tmpname, path)
+
+    def load(self, path=None):
+        """Read the manifest saved by save()."""
+
+        path = path or self.path
+        mfile = open(path, "rb")
+        try:
+            data = mfile.read()
+        finally:
+            mfile.close()
+        try:
+            magic, version, count = HEADER.unpack_from(data)
+        except struct.error:
+            raise SBError("Manifest %s is corrupted" % path)
+        if magic != MAGIC or version != VERSION:
+            raise SBError("Manifest %s has unknown format" % path)
+
+        entries = {}
+        offset = HEADER.size
+        prev = ""
+        try:
+            for _ in xrange(count):
+                shared, length, mode, size, mtime, ino, digest = \
+                    RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                fpath = prev[:shared] + data[offset:offset + length]
+                offset += length
+                if digest == NO_DIGEST:
+                    digest = None
+                entries[fpath] = (mode, size, mtime, ino, digest)
+                prev = fpath
+        except struct.error:
+            raise SBError("Manifest %s is truncated" % path)
+        self.entries = entries
+        self.children = None
@@ -0,0 +1,360 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Memoization of deterministic commands.
+
+MemoScratchbox wraps scratchbox object. Its run(), tee() and
+superuser_tee() return stored results when the same command was already
+run in the same working directory, in a target with the same fingerprint
+and with the same contents of declared input files.
+
+Target fingerprint is made of target configuration and installed
+packages (dpkg status database), which identifies the rootstrap and
+everything installed on top of it.
+
+Results are stored as <basedir>/<key[:2]>/<key>/ directories with
+"result" (JSON) and "log" files. Directory mtime is the time of the
+last use; least recently used entries are evicted to fit in the quota.
+Size of the cache is counted once per process and then kept up to date
+by put(), so the whole cache is walked only when it has to be pruned.
+"""
+
+import os
+import errno
+import time
+import shutil
+import tempfile
+import threading
+import logging
+import md5
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from scratchbox.common import check_status
+from scratchbox.capture import LogCapture, LogDispatcher, TeeResult, \
+     CompressedWriter
+from scratchbox.manifest import file_md5
+from scratchbox.toolscache import dir_size
+
+DPKG_STATUS = os.path.join("var", "lib", "dpkg", "status")
+
+# digests of files keyed by path, valid while (size, mtime, inode) match
+_digests = {}
+_digests_lock = threading.Lock()
+
+def file_digest(path):
+    """Return md5 of file contents or "-" if it doesn't exist."""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return "-"
+    ident = (stat.st_size, stat.st_mtime, stat.st_ino)
+    _digests_lock.acquire()
+    try:
+        if path in _digests and _digests[path][0] == ident:
+            return _digests[path][1]
+    finally:
+        _digests_lock.release()
+
+    digest = file_md5(path).encode("hex")
+    _digests_lock.acquire()
+    _digests[path] = (ident, digest)
+    _digests_lock.release()
+    return digest
+
+def inputs_digest(inputs):
+    """Return md5 of contents of files and directory trees."""
+
+    digest = md5.md5()
+    for path in sorted(inputs):
+        paths = [path]
+        if os.path.isdir(path):
+            paths = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                paths.extend([os.path.join(root, name)
+                              for name in sorted(files)])
+        for fname in paths:
+            digest.update("%s\0%s\0" % (fname, file_digest(fname)))
+    return digest.hexdigest()
+
+class MemoCache(object):
+    """Results of commands stored on disk."""
+
+    def __init__(self, basedir, quota=None):
+        self.basedir = basedir
+        self.quota = quota
+        self.hits = 0
+        self.misses = 0
+        # total size of entries, None until it's counted
+        self.size = None
+        self.logger = logging.getLogger(__name__)
+
+    def get_path(self, key):
+        """Return directory of the entry."""
+        return os.path.join(self.basedir, key[:2], key)
+
+    def get(self, key):
+        """Return stored result dictionary or None."""
+
+        path = self.get_path(key)
+        try:
+            result = json.loads(open(os.path.join(path, "result")).read())
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        result["path"] = path
+        return result
+
+    def put(self, key, result, logfn=None):
+        """Store result dictionary and copy of the log file."""
+
+        parent = os.path.dirname(self.get_path(key))
+        try:
+            os.makedirs(parent)
+        except OSError, exobj:
+            if exobj.errno != errno.EEXIST:
+                raise
+        tmpdir = tempfile.mkdtemp(prefix=".%s." % key, dir=parent)
+        size = 0
+        try:
+            if logfn:
+                shutil.copyfile(logfn, os.path.join(tmpdir, "log"))
+            ofile = open(os.path.join(tmpdir, "result"), "w")
+            try:
+                ofile.write(json.dumps(result))
+            finally:
+                ofile.close()
+            size = dir_size(tmpdir)
+            try:
+                os.rename(tmpdir, self.get_path(key))
+            except OSError, exobj:
+                # stored by somebody else meanwhile
+                if exobj.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                size = 0
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir, True)
+        if self.quota:
+            if self.size is None:
+                self.size = sum([esize for _, esize, _ in self.entries()])
+            else:
+                self.size += size
+            if self.size > self.quota:
+                self.prune(self.quota)
+
+    def entries(self):
+        """Return list of (last use, size, path) of all entries."""
+
+        result = []
+        if not os.path.isdir(self.basedir):
+            return result
+        for prefix in os.listdir(self.basedir):
+            pdir = os.path.join(self.basedir, prefix)
+            for name in os.listdir(pdir):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(pdir, name)
+                try:
+                    result.append((os.stat(path).st_mtime, dir_size(path),
+                                   path))
+                except OSError:
+                    pass
+        return result
+
+    def prune(self, quota):
+        """Remove least recently used entries until cache fits in quota.
+           Return: number of removed entries.
+        """
+
+        entries = self.entries()
+        entries.sort()
+        total = sum([size for _, size, _ in entries])
+        removed = 0
+        for _, size, path in entries:
+            if total <= quota:
+                break
+            # renamed first, so readers never see partial entry
+            evicted = "%s.%d.evict" % (os.path.join(os.path.dirname(path),
+                                       "." + os.path.basename(path)),
+                                       os.getpid())
+            try:
+                os.rename(path, evicted)
+            except OSError:
+                continue
+            shutil.rmtree(evicted, True)
+            total -= size
+            removed += 1
+        self.size = total
+        return removed
+
+class MemoScratchbox(object):
+    """Scratchbox object returning memoized results of commands.
+       Only commands which are run with memoize set are memoized;
+       inputs is a list of host files or directories the command reads.
+       Other attributes are taken from the wrapped object.
+    """
+
+    def __init__(self, sbox, cache):
+        self.sbox = sbox
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.sbox, name)
+
+    def get_fingerprint(self):
+        """Return fingerprint of the current target."""
+
+        digest = md5.md5(str(self.sbox.target_name))
+        config = self.sbox.get_target_config() or {}
+        for key in sorted(config):
+            digest.update("%s=%s\n" % (key, config[key]))
+        digest.update(file_digest(os.path.join(self.sbox.get_targetdir(),
+                                               DPKG_STATUS)))
+        return digest.hexdigest()
+
+    def get_key(self, kind, command, directory, inputs, *options):
+        """Return key of the command result."""
+
+        digest = md5.md5("\0".join([kind, command, str(directory),
+                                    self.sbox.__class__.__name__,
+                                    self.get_fingerprint(),
+                                    inputs_digest(inputs or ())] + \
+                                   [str(option) for option in options]))
+        return digest.hexdigest()
+
+    def run(self, command, directory=None, exe=None, fatal=True,
+            timeout=None, memoize=False, inputs=None):
+        """Run command inside scratchbox or return memoized output."""
+
+        if not memoize:
+            return self.sbox.run(command, directory, exe, fatal, timeout)
+        key = self.get_key("run", command, directory or os.getcwd(), inputs,
+                           exe)
+        result = self.cache.get(key)
+        if result:
+            self.sbox.logger.debug("memoized result of %s" % command)
+            return check_status(command, result["status"],
+                                result["output"].encode("latin-1"), fatal)
+
+        (status, output) = self.sbox.run(command, directory, exe, False,
+                                         timeout)
+        self.cache.put(key, {"status": status,
+                             "output": output.decode("latin-1")})
+        return check_status(command, status, output, fatal)
+
+    def replay(self, path, compress, consumers):
+        """Pass memoized log to consumers."""
+
+        if compress:
+            lfile = CompressedWriter.openers[compress](path, "rb")
+        else:
+            lfile = open(path, "rb")
+        dispatcher = LogDispatcher(consumers)
+        try:
+            while True:
+                data = lfile.read(65536)
+                if not data:
+                    break
+                dispatcher.feed(data)
+        finally:
+            dispatcher.close()
+            lfile.close()
+
+    def _memo_tee(self, tee, superuser, command, logfn, mode, bufsize,
+                  compress, tail, timeout, inputs, consumers):
+        """Run tee() or copy memoized log to logfn."""
+
+        # tee runs in the caller's working directory
+        key = self.get_key("tee", command, os.getcwd(), inputs, superuser,
+                           mode, compress, tail)
+        result = self.cache.get(key)
+        if result:
+            self.sbox.logger.debug("memoized log of %s" % command)
+            log = os.path.join(result["path"], "log")
+            if logfn and os.path.exists(log):
+                shutil.copyfile(log, logfn)
+            if consumers and os.path.exists(log):
+                self.replay(log, compress, consumers)
+            capture = LogCapture(logfn, bufsize, compress, tail)
+            capture.nbytes = result["nbytes"]
+            if capture.tail:
+                capture.tail.feed(result["tail"].encode("latin-1"))
+            return TeeResult(result["status"], capture)
+
+        start = time.time()
+        tmplog = None
+        if not logfn and consumers:
+            # log is stored, so consumers get output on next hits too
+            fd, tmplog = tempfile.mkstemp(prefix="sb-memo-log-")
+            os.close(fd)
+        try:
+            status = tee(command, logfn or tmplog, mode, bufsize, compress,
+                         tail, timeout, consumers)
+            if status < 0:
+                # killed by signal or timeout, nothing to memoize
+                return status
+            self.cache.put(key, {"status": int(status),
+                                 "nbytes": status.get_nbytes(),
+                                 "tail": status.get_tail().decode("latin-1"),
+                                 "elapsed": time.time() - start},
+                           logfn or tmplog)
+        finally:
+            if tmplog:
+                os.unlink(tmplog)
+        return status
+
+    def tee(self, command, logfn, mode, bufsize=0, compress=None, tail=0,
+            timeout=None, consumers=None, memoize=False, inputs=None):
+        """Tee or copy memoized log."""
+
+        if not memoize:
+            return self.sbox.tee(command, logfn, mode, bufsize, compress,
+                                 tail, timeout, consumers)
+        return self._memo_tee(self.sbox.tee, False, command, logfn, mode,
+                              bufsize, compress, tail, timeout, inputs,
+                              consumers)
+
+    def superuser_tee(self, command, logfn, mode, bufsize=0, compress=None,
+                      tail=0, timeout=None, consumers=None, memoize=False,
+                      inputs=None):
+        """Tee with root privileges or copy memoized log."""
+
+        if not memoize:
+            return self.sbox.superuser_tee(command, logfn, mode, bufsize,
+                                           compress, tail, timeout,
+                                           consumers)
+        return self._memo_tee(self.sbox.superuser_tee, True, command, logfn,
+                              mode, bufsize, compress, tail, timeout, inputs,
+                              consumers)
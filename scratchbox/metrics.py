@@ -0,0 +1,318 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Timing instrumentation.
+
+Operations decorated with instrumented() record wall time, CPU time,
+amount of transferred bytes and outcome. Samples are aggregated into
+histograms per operation and per operation and target, and are passed
+to pluggable sinks.
+
+CPU time is the one of commands run by the operation, taken from
+resource usage its result carries (TeeResult, CommandOutput). It is 0
+for other operations: CPU time of the whole process would include other
+threads and their children.
+"""
+
+import os
+import time
+import threading
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# upper bounds of histogram buckets, seconds
+BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+           1800, float("inf"))
+
+class Sample(object):
+    """Measurement of one operation."""
+
+    def __init__(self, operation, target, wall, cpu, nbytes, outcome):
+        self.operation = operation
+        self.target = target
+        self.wall = wall
+        self.cpu = cpu
+        self.nbytes = nbytes
+        self.outcome = outcome
+        self.timestamp = time.time()
+
+    def as_dict(self):
+        """Return sample as dictionary."""
+        return {"operation": self.operation, "target": self.target,
+                "wall": self.wall, "cpu": self.cpu, "bytes": self.nbytes,
+                "outcome": self.outcome, "timestamp": self.timestamp}
+
+class Histogram(object):
+    """Distribution of wall times with totals."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.nbytes = 0
+        self.errors = 0
+
+    def add(self, sample):
+        """Account sample."""
+
+        for i, bound in enumerate(BUCKETS):
+            if sample.wall <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.wall += sample.wall
+        self.cpu += sample.cpu
+        self.nbytes += sample.nbytes
+        if sample.outcome != "ok":
+            self.errors += 1
+
+class Metrics(object):
+    """Collects samples of all instrumented operations."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.sinks = []
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def add_sink(self, sink):
+        """Start passing samples to sink.emit(sample, metrics)."""
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        """Stop passing samples to sink."""
+        self.sinks.remove(sink)
+
+    def record(self, sample):
+        """Account sample and pass it to sinks."""
+
+        self.lock.acquire()
+        try:
+            keys = [(sample.operation, None)]
+            if sample.target is not None:
+                keys.append((sample.operation, sample.target))
+            for key in keys:
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                self.histograms[key].add(sample)
+        finally:
+            self.lock.release()
+
+        for sink in self.sinks[:]:
+            try:
+                sink.emit(sample, self)
+            except Exception, exobj:
+                self.logger.error("metrics sink %s failed: %s" % \
+                                  (sink, exobj))
+
+    def get_histograms(self):
+        """Return copy of histograms:
+           dictionary (operation, target) -> Histogram.
+           Target None means all targets.
+        """
+
+        self.lock.acquire()
+        try:
+            return self.histograms.copy()
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """Drop collected histograms."""
+
+        self.lock.acquire()
+        try:
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+class CallbackSink(object):
+    """Calls callback(sample) for every sample."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, sample, metrics):
+        """Pass sample to callback."""
+        self.callback(sample)
+
+class JSONLinesSink(object):
+    """Appends samples to file as JSON objects, one per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, sample, metrics):
+        """Write sample to the file."""
+
+        line = json.dumps(sample.as_dict()) + "\n"
+        self.lock.acquire()
+        try:
+            sfile = open(self.path, "a")
+            try:
+                sfile.write(line)
+            finally:
+                sfile.close()
+        finally:
+            self.lock.release()
+
+def _label(value):
+    """Escape Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+                     .replace("\n", "\\n")
+
+class PrometheusSink(object):
+    """Writes histograms to file in Prometheus text format.
+       Suitable for textfile collector of node exporter. File is
+       rewritten at most once per interval seconds.
+    """
+
+    prefix = "scratchbox_operation"
+
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def emit(self, sample, metrics):
+        """Rewrite the file if interval has passed."""
+        if time.time() - self.written >= self.interval:
+            self.write(metrics)
+
+    def format(self, metrics):
+        """Return histograms in Prometheus text format.
+           Every metric family is one group with its own TYPE line.
+        """
+
+        histograms = metrics.get_histograms()
+        keys = histograms.keys()
+        keys.sort()
+        series = []
+        for operation, target in keys:
+            labels = 'operation="%s"' % _label(operation)
+            if target is not None:
+                labels += ',target="%s"' % _label(target)
+            series.append((labels, histograms[(operation, target)]))
+
+        lines = ["# TYPE %s_seconds histogram" % self.prefix]
+        for labels, hist in series:
+            total = 0
+            for bound, count in zip(BUCKETS, hist.buckets):
+                total += count
+                if bound == float("inf"):
+                    bound = "+Inf"
+                lines.append('%s_seconds_bucket{%s,le="%s"} %d' % \
+                             (self.prefix, labels, bound, total))
+            lines.append("%s_seconds_sum{%s} %f" % (self.prefix, labels,
+                                                    hist.wall))
+            lines.append("%s_seconds_count{%s} %d" % (self.prefix, labels,
+                                                      hist.count))
+        for name, attr, fmt in (("cpu_seconds_total", "cpu", "%f"),
+                                ("bytes_total", "nbytes", "%d"),
+                                ("errors_total", "errors", "%d")):
+            lines.append("# TYPE %s_%s counter" % (self.prefix, name))
+            for labels, hist in series:
+                lines.append(("%s_%s{%s} " + fmt) % \
+                             (self.prefix, name, labels, getattr(hist, attr)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics):
+        """Write the file atomically."""
+
+        self.lock.acquire()
+        try:
+            tmpname = "%s.%d" % (self.path, os.getpid())
+            sfile = open(tmpname, "w")
+            try:
+                sfile.write(self.format(metrics))
+            finally:
+                sfile.close()
+            os.rename(tmpname, self.path)
+            self.written = time.time()
+        finally:
+            self.lock.release()
+
+# metrics of all scratchbox objects in the process
+metrics = Metrics()
+
+def count_bytes(result):
+    """Guess amount of bytes transferred by operation from its result."""
+
+    if hasattr(result, "get_nbytes"):
+        return result.get_nbytes()
+    if isinstance(result, str):
+        return len(result)
+    if isinstance(result, tuple) and len(result) == 2 and \
+       isinstance(result[1], str):
+        return len(result[1])
+    return 0
+
+def child_cpu(result):
+    """Return CPU time of commands from resource usage in result."""
+
+    if isinstance(result, tuple) and len(result) == 2:
+        result = result[1]
+    usage = hasattr(result, "get_usage") and result.get_usage()
+    if usage:
+        return usage.get_cpu()
+    return 0.0
+
+def instrumented(operation, nbytes=None):
+    """Decorator recording samples of method calls.
+       nbytes(obj, result) returns amount of transferred bytes,
+       count_bytes() is used by default.
+    """
+
+    def decorator(method):
+        def wrapper(self, *args, **kwargs):
+            wall = time.time()
+            outcome = "ok"
+            result = None
+            try:
+                try:
+                    result = method(self, *args, **kwargs)
+                    return result
+                except Exception, exobj:
+                    outcome = exobj.__class__.__name__
+                    raise
+            finally:
+                if nbytes:
+                    transferred = nbytes(self, result)
+                else:
+                    transferred = count_bytes(result)
+                target = getattr(self, "target_name", None) or None
+                metrics.record(Sample(operation, target,
+                                      time.time() - wall, child_cpu(result),
+                                      transferred or 0, outcome))
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorator
@@ -0,0 +1,160 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Cached target registry.
+
+Target list, selected target and target configs are cached in process.
+Cache is dropped as soon as mtime of any watched path changes, e.g.
+when target is created, removed or selected by another process.
+"""
+
+import os
+import re
+import threading
+
+CONFIG_RE = re.compile("^\s*(?:export\s+)?([A-Za-z_]\w*)=(.*)$")
+
+def parse_config(path):
+    """Parse shell-like KEY=value config file into dictionary."""
+
+    config = {}
+    try:
+        cfile = open(path)
+    except IOError:
+        return config
+    try:
+        for line in cfile:
+            match = CONFIG_RE.match(line)
+            if match:
+                value = match.group(2).strip()
+                if len(value) > 1 and value[0] == value[-1] and \
+                   value[0] in "\"'":
+                    value = value[1:-1]
+                config[match.group(1)] = value
+    finally:
+        cfile.close()
+    return config
+
+class TargetRegistry(object):
+    """Cache of target information invalidated by mtime of watched paths."""
+
+    def __init__(self, watched):
+        self.watched = watched
+        self.stamp = None
+        self.targets = None
+        self.selected = None
+        self.configs = {}
+        self.lock = threading.RLock()
+
+    def get_stamp(self):
+        """Return mtimes of watched paths."""
+
+        stamp = []
+        for path in self.watched:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def invalidate(self):
+        """Drop cached data."""
+
+        self.lock.acquire()
+        try:
+            self.targets = None
+            self.selected = None
+            self.configs = {}
+            self.stamp = None
+        finally:
+            self.lock.release()
+
+    def check(self):
+        """Drop cached data if watched paths have changed."""
+
+        stamp = self.get_stamp()
+        if stamp != self.stamp:
+            self.invalidate()
+            self.stamp = stamp
+
+    def get_targets(self, loader):
+        """Return list of targets. loader() is called on cache miss."""
+
+        self.lock.acquire()
+        try:
+            self.check()
+            if self.targets is None:
+                self.targets = loader()
+            return self.targets
+        finally:
+            self.lock.release()
+
+    def get_selected(self, loader):
+        """Return selected target. loader() is called on cache miss."""
+
+        self.lock.acquire()
+        try:
+            self.check()
+            if self.selected is None:
+                self.selected = loader()
+            return self.selected
+        finally:
+            self.lock.release()
+
+    def set_selected(self, name):
+        """Remember target selected by this process."""
+
+        self.lock.acquire()
+        try:
+            self.check()
+            self.selected = name
+        finally:
+            self.lock.release()
+
+    def get_config(self, name, loader):
+        """Return config of the target. loader(name) is called on miss."""
+
+        self.lock.acquire()
+        try:
+            self.check()
+            if name not in self.configs:
+                self.configs[name] = loader(name)
+            return self.configs[name]
+        finally:
+            self.lock.release()
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+def get_registry(watched):
+    """Return registry shared by all objects watching the same paths."""
+
+    key = tuple(watched)
+    _registries_lock.acquire()
+    try:
+        if key not in _registries:
+            _registries[key] = TargetRegistry(list(watched))
+        return _registries[key]
+    finally:
+        _registries_lock.release()
@@ -0,0 +1,583 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Remote build workers.
+
+Worker daemon wraps local Scratchbox1 or Scratchbox2 and serves setup(),
+extract_rootstrap(), run() and tee() over TCP. RemoteScratchbox client
+places every job on the least loaded worker of the pool.
+
+Workers run commands of anybody who can connect, so every request has to
+carry the token the worker was started with, and the daemon listens on
+localhost unless told otherwise. Commands are always run by the worker's
+scratchbox executable.
+
+Protocol: client sends request as one JSON line and reads responses,
+one JSON line each, until "result" or "error" response:
+    {"type": "log", "size": N}      followed by N bytes of output
+    {"type": "result", ...}         outcome of the request
+    {"type": "error", "message": M} request failed with SBError
+Strings are passed as latin-1, so any byte sequence survives.
+Requests without valid "token" are answered with error and the
+connection is closed.
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+import logging
+import SocketServer
+
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from scratchbox.common import Scratchbox, SBError, Process, CommandOutput, \
+     check_status
+from scratchbox.capture import LogCapture, TeeResult
+from scratchbox.accounting import ResourceUsage, accounting
+from scratchbox.metrics import instrumented
+
+DEFAULT_PORT = 7788
+TOKEN_ENV = "SCRATCHBOX_WORKER_TOKEN"
+
+def get_token(token=None):
+    """Return given token or the one from environment."""
+
+    token = token or os.environ.get(TOKEN_ENV)
+    if not token:
+        raise SBError("No worker token given, set %s" % TOKEN_ENV)
+    return token
+
+def check_token(expected, given):
+    """Compare tokens in time not depending on the matching prefix."""
+
+    if not isinstance(given, basestring) or len(given) != len(expected):
+        return False
+    result = 0
+    for left, right in zip(expected, given):
+        result |= ord(left) ^ ord(right)
+    return result == 0
+
+def send_message(wfile, message, data=None):
+    """Write JSON line followed by raw data if any."""
+
+    wfile.write(json.dumps(message) + "\n")
+    if data:
+        wfile.write(data)
+    wfile.flush()
+
+def read_message(rfile):
+    """Read JSON line. Return: dictionary or None on EOF."""
+
+    line = rfile.readline()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise SBError("Malformed message: %r" % line)
+
+def load_usage(data):
+    """Convert dictionary made by ResourceUsage.as_dict() back."""
+
+    if not data:
+        return None
+    usage = ResourceUsage()
+    for key, value in data.items():
+        setattr(usage, str(key), value)
+    return usage
+
+class WorkerHandler(SocketServer.StreamRequestHandler):
+    """Serves requests of one client connection."""
+
+    def handle(self):
+        """Read and serve requests until client disconnects."""
+
+        while True:
+            try:
+                request = read_message(self.rfile)
+            except SBError, exobj:
+                send_message(self.wfile, {"type": "error",
+                                          "message": str(exobj)})
+                return
+            if request is None:
+                return
+            if not check_token(self.server.token, request.get("token")):
+                self.server.worker.logger.warning("rejected request from %s"
+                                                  % (self.client_address,))
+                send_message(self.wfile, {"type": "error",
+                                          "message": "Invalid token"})
+                return
+            self.server.worker.serve(request, self.wfile)
+
+class Worker(object):
+    """Runs requests of remote clients in local scratchbox.
+       One scratchbox object is kept per target, so state made by
+       setup() is used by following requests for the same target.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.instances = {}
+        self.jobs = 0
+        self.lock = threading.Lock()
+        # serializes requests if there is only one selected target
+        self.target_lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def get_instance(self, target):
+        """Return scratchbox object of the target."""
+
+        self.lock.acquire()
+        try:
+            if target not in self.instances:
+                sbox = self.factory()
+                if target:
+                    sbox.set_target_name(target)
+                self.instances[target] = sbox
+            return self.instances[target]
+        finally:
+            self.lock.release()
+
+    def get_status(self):
+        """Return load information used by clients for placement."""
+        return {"type": "result", "jobs": self.jobs,
+                "cpus": os.sysconf("SC_NPROCESSORS_ONLN"),
+                "load": os.getloadavg()[0]}
+
+    def serve(self, request, wfile):
+        """Run request, writing responses to wfile."""
+
+        operation = request.get("op")
+        if operation == "status":
+            send_message(wfile, self.get_status())
+            return
+        handler = getattr(self, "op_%s" % operation, None)
+        if not handler:
+            send_message(wfile, {"type": "error",
+                                 "message": "Unknown operation %s" % \
+                                            operation})
+            return
+
+        sbox = self.get_instance(request.get("target"))
+        self.lock.acquire()
+        self.jobs += 1
+        self.lock.release()
+        exclusive = not sbox.parallel_targets
+        if exclusive:
+            self.target_lock.acquire()
+        try:
+            try:
+                if exclusive and sbox.target_name:
+                    sbox.select(sbox.target_name)
+                result = handler(sbox, request, wfile)
+            except socket.error:
+                return
+            except Exception, exobj:
+                self.logger.error("%s failed: %s" % (operation, exobj))
+                result = {"type": "error", "message": str(exobj)}
+        finally:
+            if exclusive:
+                self.target_lock.release()
+            self.lock.acquire()
+            self.jobs -= 1
+            self.lock.release()
+        send_message(wfile, result)
+
+    def op_setup(self, sbox, request, wfile):
+        """Set up the target."""
+        sbox.setup(request["params"], request.get("force"))
+        return {"type": "result"}
+
+    def op_create_target(self, sbox, request, wfile):
+        """Pass target parameters to scratchbox."""
+        sbox.create_target(sbox.target_name, request["params"])
+        return {"type": "result"}
+
+    def op_extract_rootstrap(self, sbox, request, wfile):
+        """Extract rootstrap available on the worker into target."""
+        sbox.extract_rootstrap(request["rootstrap"])
+        return {"type": "result"}
+
+    def op_run(self, sbox, request, wfile):
+        """Run command inside scratchbox, return its output."""
+
+        (status, output) = sbox.run(request["command"],
+                                    request.get("directory"), fatal=False,
+                                    timeout=request.get("timeout"),
+                                    accounting=True)
+        return {"type": "result", "status": status,
+                "output": output.decode("latin-1"),
+                "usage": output.usage and output.usage.as_dict()}
+
+    def op_tee(self, sbox, request, wfile):
+        """Run command streaming its output to the client."""
+
+        command = sbox.get_tee_command(request["command"], request["mode"],
+                                       request.get("superuser"))
+        devnull = open(os.devnull)
+        try:
+            proc = Process("%s %s" % (sbox.exe, command),
+                           timeout=request.get("timeout"), stdin=devnull)
+        finally:
+            devnull.close()
+
+        def send_log(data):
+            send_message(wfile, {"type": "log", "size": len(data)}, data)
+
+        try:
+            proc.pump(send_log)
+        except socket.error:
+            # client is gone, nobody needs the command anymore
+            proc.kill()
+            proc.wait()
+            raise
+        status = proc.wait()
+        accounting.record("tee", sbox.target_name, proc.usage)
+        if os.WIFEXITED(status):
+            status = os.WEXITSTATUS(status)
+        else:
+            status = -1
+        return {"type": "result", "status": status,
+                "usage": proc.usage and proc.usage.as_dict()}
+
+class WorkerServer(SocketServer.ThreadingTCPServer):
+    """Worker daemon. Every connection is served by its own thread."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, factory, token=None):
+        self.token = get_token(token)
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 WorkerHandler)
+        self.worker = Worker(factory)
+        self.thread = None
+
+    def get_address(self):
+        """Return "host:port" the server listens on."""
+        return "%s:%d" % self.server_address[:2]
+
+    def start(self):
+        """Serve requests on background thread."""
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving requests."""
+
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        self.thread = None
+
+class WorkerClient(object):
+    """Connection parameters and load of one worker."""
+
+    # seconds before unreachable worker is tried again
+    retry_interval = 30
+
+    def __init__(self, address, token):
+        self.token = token
+        host, port = address, DEFAULT_PORT
+        if ":" in address:
+            host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.jobs = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "%s:%d" % self.address
+
+    def connect(self):
+        """Open connection. Return: (socket, rfile, wfile)."""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.address)
+        except socket.error:
+            sock.close()
+            raise
+        return (sock, sock.makefile("rb"), sock.makefile("wb"))
+
+    def request(self, request, consumer=None):
+        """Send request, pass streamed output to consumer(data).
+           Return: result response.
+        """
+
+        try:
+            sock, rfile, wfile = self.connect()
+        except socket.error, exobj:
+            self.failed = time.time()
+            raise SBError("Can't connect to worker %s: %s" % (self, exobj))
+        request["token"] = self.token
+        try:
+            try:
+                send_message(wfile, request)
+                while True:
+                    message = read_message(rfile)
+                    if message is None:
+                        raise SBError("Worker %s closed connection" % self)
+                    if message["type"] == "log":
+                        data = rfile.read(message["size"])
+                        if consumer:
+                            consumer(data)
+                    elif message["type"] == "error":
+                        raise SBError("Worker %s: %s" % \
+                                      (self, message["message"]))
+                    else:
+                        return message
+            except socket.error, exobj:
+                self.failed = time.time()
+                raise SBError("Worker %s failed: %s" % (self, exobj))
+        finally:
+            rfile.close()
+            wfile.close()
+            sock.close()
+
+    def is_available(self):
+        """Check if the worker isn't known to be unreachable."""
+        return time.time() - self.failed >= self.retry_interval
+
+    def get_load(self):
+        """Return load of the worker: running jobs per CPU and
+           load average per CPU. Jobs placed by this client are counted
+           even if the worker hasn't started them yet.
+        """
+
+        status = self.request({"op": "status"})
+        cpus = max(1, status["cpus"])
+        jobs = max(status["jobs"], self.jobs)
+        return (float(jobs + 1) / cpus, status["load"] / cpus)
+
+    def acquire(self):
+        """Account job placed on the worker."""
+        self.lock.acquire()
+        self.jobs += 1
+        self.lock.release()
+
+    def release(self):
+        """Account finished job."""
+        self.lock.acquire()
+        self.jobs -= 1
+        self.lock.release()
+
+class RemoteScratchbox(Scratchbox):
+    """Scratchbox running jobs on a pool of worker daemons.
+
+       run() and tee() go to the least loaded worker. setup(),
+       create_target() and extract_rootstrap() are done on all workers,
+       so jobs of the target can be placed on any of them. Workers which
+       failed to prepare the target don't get its jobs. Rootstrap paths
+       are paths on the workers. Token is taken from SCRATCHBOX_WORKER_TOKEN
+       environment variable if not given.
+    """
+
+    parallel_targets = True
+
+    def __init__(self, workers, target_name=None, token=None):
+        token = get_token(token)
+        self.workers = [WorkerClient(address, token) for address in workers]
+        if not self.workers:
+            raise SBError("No workers given")
+        # target -> workers which failed to prepare it
+        self.broken = {}
+        Scratchbox.__init__(self, target_name)
+
+    def select(self, tname):
+        """Use target for following requests."""
+        self.target_name = tname
+
+    def place(self):
+        """Return the least loaded available worker."""
+
+        best = None
+        broken = self.broken.get(self.target_name, ())
+        for worker in self.workers:
+            if worker in broken or not worker.is_available():
+                continue
+            try:
+                load = worker.get_load()
+            except SBError, exobj:
+                self.logger.warning("skipping worker: %s" % exobj)
+                continue
+            if best is None or load < best[0]:
+                best = (load, worker)
+        if best is None:
+            raise SBError("No workers available")
+        self.logger.debug("placing job on %s, load %.2f" % \
+                          (best[1], best[0][0]))
+        return best[1]
+
+    def _submit(self, request, consumer=None):
+        """Run request on the least loaded worker."""
+
+        request["target"] = self.target_name
+        worker = self.place()
+        worker.acquire()
+        try:
+            return worker.request(request, consumer)
+        finally:
+            worker.release()
+
+    def _broadcast(self, request):
+        """Run request on all workers at once. Workers which fail are
+           excluded from placement of the target's jobs. Raises the first
+           error if no worker succeeded.
+        """
+
+        request["target"] = self.target_name
+        broken = self.broken.setdefault(self.target_name, [])
+        workers = [worker for worker in self.workers if worker not in broken]
+        errors = []
+
+        def call(worker):
+            try:
+                worker.request(request)
+            except SBError, exobj:
+                errors.append((worker, exobj))
+
+        threads = [threading.Thread(target=call, args=(worker,))
+                   for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(errors) == len(workers):
+            raise errors and errors[0][1] or SBError("No workers available")
+        for worker, exobj in errors:
+            self.logger.warning("excluding worker: %s" % exobj)
+            broken.append(worker)
+
+    @instrumented("setup")
+    def setup(self, target, force=None):
+        """Setup target on all workers."""
+        self.target_name = target["name"]
+        self.broken[self.target_name] = []
+        self._broadcast({"op": "setup", "params": target, "force": force})
+
+    def create_target(self, name, params):
+        """Create target on all workers."""
+        self.target_name = name
+        self.broken[self.target_name] = []
+        self._broadcast({"op": "create_target", "params": params})
+
+    @instrumented("extract_rootstrap")
+    def extract_rootstrap(self, rootstrap):
+        """Extract rootstrap on all workers."""
+        self._broadcast({"op": "extract_rootstrap", "rootstrap": rootstrap})
+
+    @instrumented("run")
+    def run(self, command, directory=None, exe=None, fatal=True,
+            timeout=None, accounting=False):
+        """Run command on a worker. Directory is a worker path.
+           Workers run commands only inside scratchbox, so exe can't be set.
+        """
+
+        if exe:
+            raise SBError("Workers can't run %s" % exe)
+        result = self._submit({"op": "run", "command": command,
+                               "directory": directory, "timeout": timeout})
+        output = result["output"].encode("latin-1")
+        if accounting:
+            output = CommandOutput(output, result["status"],
+                                   load_usage(result["usage"]))
+        return check_status(command, result["status"], output, fatal)
+
+    def _remote_tee(self, command, logfn, mode, superuser, bufsize,
+                    compress, tail, timeout, consumers):
+        """Run command on a worker writing its output to local log."""
+
+        capture = LogCapture(logfn, bufsize, compress, tail, consumers)
+        capture.open()
+        try:
+            result = self._submit({"op": "tee", "command": command,
+                                   "mode": mode, "superuser": superuser,
+                                   "timeout": timeout}, capture.feed)
+        finally:
+            capture.close()
+        usage = load_usage(result["usage"])
+        accounting.record("tee", self.target_name, usage)
+        return TeeResult(result["status"], capture, usage)
+
+    @instrumented("tee")
+    def tee(self, command, logfn, mode, bufsize=0, compress=None, tail=0,
+            timeout=None, consumers=None):
+        """Tee."""
+        return self._remote_tee(command, logfn, mode, False, bufsize,
+                                compress, tail, timeout, consumers)
+
+    @instrumented("tee")
+    def superuser_tee(self, command, logfn, mode, bufsize=0, compress=None,
+                      tail=0, timeout=None, consumers=None):
+        """Tee with root privileges."""
+        return self._remote_tee(command, logfn, mode, True, bufsize,
+                                compress, tail, timeout, consumers)
+
+def main(argv=None):
+    """Run worker daemon."""
+
+    from scratchbox import scratchbox_factory
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-l", "--listen", default="127.0.0.1",
+                      help="address to listen on [%default]")
+    parser.add_option("-p", "--port", type="int", default=DEFAULT_PORT,
+                      help="port to listen on [%default]")
+    parser.add_option("-s", "--sbver", type="int", default=2,
+                      help="scratchbox version [%default]")
+    parser.add_option("-t", "--token-file",
+                      help="file with token clients have to send "
+                           "[$%s]" % TOKEN_ENV)
+    options, _ = parser.parse_args(argv)
+
+    token = None
+    if options.token_file:
+        token = open(options.token_file).read().strip()
+    try:
+        token = get_token(token)
+    except SBError, exobj:
+        parser.error(str(exobj))
+
+    logging.basicConfig(level=logging.INFO)
+    server = WorkerServer((options.listen, options.port),
+                          lambda: scratchbox_factory(options.sbver), token)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -31,6 +31,8 @@ import re
 import signal
 
 from scratchbox.common import Scratchbox, SBError
+from scratchbox.registry import get_registry, parse_config
+from scratchbox.metrics import instrumented
 
 class Scratchbox1(Scratchbox):
     """Scratchbox 1 API,"""
@@ -40,11 +42,32 @@ class Scratchbox1(Scratchbox):
         self.exe = "/scratchbox/login"
         self.logger.debug("Scratchbox1 instance created.")
 
+    def get_registry(self):
+        """Returns cache of targets shared by objects of the same user."""
+        targets = os.path.join(self.get_basedir(), "targets")
+        return get_registry([targets, os.path.join(targets, "links")])
+
     def lstargets(self):
         """List targets."""
-        return self.run("list --targets 2>/dev/null",
-                        exe="sb-conf").split("\n")
-
+        return self.get_registry().get_targets(lambda:
+            self._run_direct("list --targets 2>/dev/null",
+                             exe="sb-conf").split("\n"))
+
+    def get_selected(self):
+        """Returns name of selected target."""
+        return self.get_registry().get_selected(lambda:
+            parse_config(os.path.join(self.get_basedir(), "targets", "links",
+                         "scratchbox.config")).get("SBOX_TARGET_NAME"))
+
+    def get_target_config(self, tname=None):
+        """Returns configuration of the target as dictionary."""
+        if not tname:
+            tname = self.target_name
+        return self.get_registry().get_config(tname, lambda name:
+            parse_config(os.path.join(self.get_basedir(), "targets",
+                                      name + ".config")))
+
+    @instrumented("setup")
     def setup(self, target, force=None):
         """Setup target."""
 
@@ -57,15 +80,19 @@ class Scratchbox1(Scratchbox):
             cmdl += " --force"
         cmdl = "sb-conf setup %s %s" % (target["name"], cmdl)
         self.logger.debug("setting up the target: %s" % cmdl)
-        return self.run(cmdl)
+        try:
+            return self._run_direct(cmdl)
+        finally:
+            self.get_registry().invalidate()
 
     def reset(self, tname):
         """Reset target and put required libraries in place."""
         self.killall(signal.SIGTERM)
-        self.run("sb-conf select %s" % tname)
+        self.get_registry().invalidate()
+        self._run_direct("sb-conf select %s" % tname)
 
         # check if we really selected target
-        output = self.run('cat /targets/links/scratchbox.config')
+        output = self._run_direct('cat /targets/links/scratchbox.config')
         match = re.search("\n*SBOX_TARGET_NAME=(.+)\n*", output, re.M)
         if not match:
             self.logger.error("Can't find target in output: %s" % output)
@@ -74,11 +101,22 @@ class Scratchbox1(Scratchbox):
             self.logger.error("Wrong target selected: %s instead of %s" % \
                               (match.group(1), tname))
             raise SBError("Failed to select target %s, exiting" % tname)
-        return self.run("sb-conf reset %s --force" % tname)
+        return self._run_direct("sb-conf reset %s --force" % tname)
 
+    def rollback(self, name):
+        """Restore state of the current target saved by checkpoint()."""
+        # processes inside scratchbox can hold files of the target
+        self.killall(signal.SIGTERM)
+        return Scratchbox.rollback(self, name)
+
+    @instrumented("select")
     def select(self, tname):
-        """Select target."""
-        return self.run("sb-conf select %s" % tname)
+        """Select target. Does nothing if target is selected already."""
+        if self.get_selected() == tname:
+            return ""
+        output = self._run_direct("sb-conf select %s" % tname)
+        self.get_registry().set_selected(tname)
+        return output
 
     def remove(self, tname):
         """Remove target."""
@@ -90,20 +128,33 @@ class Scratchbox1(Scratchbox):
                 self.select(target)
                 break
 
-        return self.run("sb-conf remove %s -f" % tname)
+        try:
+            return self._run_direct("sb-conf remove %s -f" % tname)
+        finally:
+            self.get_registry().invalidate()
 
     def killall(self, sig=signal.SIGHUP):
         """Send signals to all processes inside scratchbox."""
-        return self.run("sb-conf killall --signal=%d" % sig)
+        return self._run_direct("sb-conf killall --signal=%d" % sig)
 
-    def tee(self, command, logfn, mode, bufsize=0):
+    def get_tee_command(self, command, mode, superuser=False):
+        """Returns scratchbox arguments used by tee() to run command."""
+        if superuser:
+            return "fakeroot %s" % command
+        return command
+
+    def tee(self, command, logfn, mode, bufsize=0, compress=None, tail=0,
+            timeout=None, consumers=None):
         """Tee."""
-        return self._tee(command, logfn, bufsize)
+        return self._tee(self.get_tee_command(command, mode), logfn, bufsize,
+                         compress, tail, timeout, consumers)
 
-    def superuser_tee(self, command, logfn, mode, bufsize=0):
+    def superuser_tee(self, command, logfn, mode, bufsize=0, compress=None,
+                      tail=0, timeout=None, consumers=None):
         """Tee with root privileges."""
 
-        return self.tee("fakeroot %s" % command, logfn, mode, bufsize)
+        return self._tee(self.get_tee_command(command, mode, True),
+                         logfn, bufsize, compress, tail, timeout, consumers)
 
     def get_basedir(self):
         """Returns absolute path to scratchbox base directory."""
@@ -123,6 +174,25 @@ class Scratchbox1(Scratchbox):
         """Returns absolute path to scratchbox temporary directory."""
         return os.path.join(self.get_basedir(), "tmp")
 
+    def get_host_path(self, sb_path):
+        """Returns host path of the path inside scratchbox.
+           Relative paths are relative to the home directory.
+        """
+        if sb_path.startswith(os.sep):
+            return os.path.join(self.get_basedir(), sb_path.lstrip(os.sep))
+        return os.path.join(self.get_homedir(), sb_path)
+
+    def get_sb_path(self, host_path):
+        """Returns path inside scratchbox of absolute host path or None
+           if it's outside of the scratchbox base directory.
+        """
+        basedir = self.get_basedir()
+        if host_path == basedir:
+            return os.sep
+        if host_path.startswith(basedir + os.sep):
+            return host_path[len(basedir):]
+        return None
+
     def get_sb_tmpdir(self):
         """Returns path to temporary directory inside scratchbox."""
         return "/tmp"
@@ -135,10 +205,12 @@ class Scratchbox1(Scratchbox):
         """Returns superuser command used inside scratchbox."""
         return "fakeroot"
 
+    @instrumented("extract_rootstrap")
     def extract_rootstrap(self, rootstrap):
         """Extracts given rootstrap into target."""
 
-        (status, output) = self.run("sb-conf rs %s" % rootstrap, fatal=False)
+        (status, output) = self._run_direct("sb-conf rs %s" % rootstrap,
+                                            fatal=False)
         if output.find("_SBOX_RESTART_FILE") >= 0:
             # Workarround
             status = 0
@@ -172,4 +244,4 @@ class Scratchbox1(Scratchbox):
 
         if files and isinstance(files, (types.TupleType, types.ListType) ):
             cmd_args = "sb-conf in --" + " --".join(files)
-            self.run(cmd_args)
+            self._run_direct(cmd_args)
@@ -26,30 +26,58 @@ Scratchbox v.2 python API
 """
 
 import os
-import urllib
+import errno
 import time
-import re
+import urllib2
 import shutil
-import socket
-import stat
+import threading
 import logging
 import md5
 
 from urlparse import urlparse
-from tarfile import TarFile
+from tarfile import TarFile, TarError
 
 from scratchbox.common import Scratchbox, SBError, run_command
+from scratchbox.download import stream_extract, SegmentedDownload
+from scratchbox.toolscache import ToolsCache, ToolsMetadata
+from scratchbox.locking import FileLock
+from scratchbox.registry import get_registry, parse_config
+from scratchbox.metrics import instrumented
+from scratchbox.asyncsb import Job
 
 class ToolsRootstrap(object):
     """Represents tools rootstraps for Scratchbox2."""
 
     basedir = "/opt/maemo/tools-rootstraps"
-
-    def __init__(self, tools_url):
-        """Constructor."""
+    # extract tarball while it's being downloaded. It needs no space for
+    # the tarball and extraction overlaps the download, but the stream
+    # uses single connection and can't be resumed: if it fails, the
+    # tarball is fetched again from the start by segmented download, and
+    # nothing is kept if the process dies. Turn it off for big tools
+    # rootstraps on slow or unreliable links.
+    streaming = True
+    # size limit of basedir in bytes, None means unlimited
+    cache_quota = None
+    # cached .full digest is used without revalidation for that many seconds
+    metadata_ttl = 0
+    # use only cached tools rootstraps, never access the server
+    offline = False
+    # parallel connections of segmented download, used when streaming is
+    # off or fails
+    connections = 4
+
+    def __init__(self, tools_url, mirrors=()):
+        """Constructor. mirrors are URLs of the same tools rootstrap
+           on other servers, used if tools_url fails.
+        """
 
         self.tools_url = tools_url
+        self.mirrors = list(mirrors)
         self.tools_dir = None
+        self.lock = None
+        self.job = None
+        # amount of downloaded bytes
+        self.nbytes = 0
         _, self.netloc, path, _, _, _ = urlparse(tools_url)
         if not self.netloc and os.path.isdir(path):
             self.tools_dir = path
@@ -64,18 +92,38 @@ class ToolsRootstrap(object):
 
         tmp_tools_dir = tools_dir + ".tmp"
         os.makedirs(tmp_tools_dir)
-        self.create_lock(tmp_tools_dir)
+        self.nbytes = 0
         self.logger.debug("Fetching %s-rootstrap.tgz" % self.name)
-        tmpfile_name, _ = urllib.urlretrieve(os.path.join(self.tools_url,
-                                               self.name + "-rootstrap.tgz"))
+        urls = [os.path.join(url, self.name + "-rootstrap.tgz")
+                for url in [self.tools_url] + self.mirrors]
+        if self.streaming:
+            try:
+                self.nbytes = stream_extract(urls, tmp_tools_dir)
+                os.rename(tmp_tools_dir, tools_dir)
+                return
+            except (SBError, EnvironmentError, TarError), exobj:
+                # stream can't be resumed, segmented download can
+                self.logger.warning("Streaming %s failed: %s, downloading "
+                                    "it in segments" % (self.name, exobj))
+                shutil.rmtree(tmp_tools_dir)
+                os.makedirs(tmp_tools_dir)
+
+        # tarball is kept next to tools_dir, so download interrupted
+        # by a crash continues when it's started again
+        download = SegmentedDownload(urls, tools_dir + ".tgz",
+                                     self.connections)
+        tmpfile_name = download.run()
+        self.nbytes += download.nbytes
         tarfile = TarFile.open(name=tmpfile_name, mode='r:gz')
         # python2.4 doesn't support extractall method for TarFile
         # tarfile.extractall(path=tools_dir + ".tmp")
         for member in tarfile:
             tarfile.extract(member, path=tmp_tools_dir)
         tarfile.close()
+        os.unlink(tmpfile_name)
         os.rename(tmp_tools_dir, tools_dir)
 
+    @instrumented("download", nbytes=lambda obj, result: obj.nbytes)
     def download(self):
         """Download tools rootstrap."""
 
@@ -83,120 +131,181 @@ class ToolsRootstrap(object):
             raise SBError("Tools rootstrap is not remote. "
                                 "No need to download")
 
-        self.logger.debug("Fetching %s/%s.full" %
-                          (self.tools_url, self.name))
-        full = urllib.urlopen(os.path.join(self.tools_url, self.name + ".full"))
         # check if tools rootstrap exists in local cache already
         tools_url_md5 = md5.md5(self.tools_url).hexdigest()
-        full_md5 = md5.md5(full.read()).hexdigest()
-        full.close()
+        full_md5 = self.get_full_md5(tools_url_md5)
         tools_dir = os.path.join(self.basedir, tools_url_md5, full_md5)
+
+        self.create_lock(tools_dir)
+        if not os.path.exists(tools_dir) and self.offline:
+            self.remove_lock()
+            raise SBError("Tools rootstrap %s is not in cache and offline "
+                          "mode is set" % self.tools_url)
         if not os.path.exists(tools_dir):
-            # tools rootstrap doesn't exist yet
-
-            # check if .tmp directory with rootstrap exists
-            tmp_tools_dir = tools_dir + ".tmp"
-            if os.path.exists(tmp_tools_dir):
-                # check if .tmp directory was created by dead process
-                pid_alive = None
-                locks = [fname for fname in os.listdir(tmp_tools_dir)
-                         if fname.endswith(".lock")]
-                self.logger.debug("Found locks: %s" % locks)
-                for lock in locks:
-                    match = re.match("\w+@([\w\.-]+)\.(\d+)\.lock", lock)
-                    if match:
-                        pid = int(match.group(2))
-                        self.logger.debug("Checking process %d..." % pid)
-                        try:
-                            os.kill(pid, 0)
-                            pid_alive = pid
-                            self.logger.debug("Living process found: %d" % pid)
-                            break
-                        except OSError, exobj:
-                            if exobj.errno == 1:
-                                pid_alive = pid
-                                self.logger.debug("Living process found: %d" \
-                                                  % pid)
-                                break
-                    else:
-                        raise SBError("Lock doesn't match regex")
-                if pid_alive: # wait for another process finishes downloading
-                    timeout = 300
-                    delta = 5
-                    while timeout > 0:
-                        time.sleep(delta)
-                        timeout -= delta
-                        if os.path.exists(tools_dir):
-                            self.create_lock(tools_dir)
-                            break
-                    if timeout < 1:
-                        raise SBError("Stopped to wait for tools"
-                                            " rootstrap because of timeout")
-                else: # re-download tools rootstrap
-                    self.logger.debug("No living processes found: "
-                                      "re-downloading tools rootstrap")
-                    shutil.rmtree(tmp_tools_dir)
+            # tools rootstrap doesn't exist yet. Only one process downloads
+            # it, others wait on the download lock until it's done. Shared
+            # lock of users is never converted: conversion isn't atomic and
+            # would wait for all other users to finish.
+            self.logger.debug("Waiting for download lock on %s" % tools_dir)
+            dl_lock = FileLock(tools_dir + ".dl.lock")
+            dl_lock.acquire(exclusive=True)
+            try:
+                if not os.path.exists(tools_dir):
+                    tmp_tools_dir = tools_dir + ".tmp"
+                    if os.path.exists(tmp_tools_dir):
+                        # nobody else holds the lock: left by dead process
+                        self.logger.debug("Removing unfinished download %s" \
+                                          % tmp_tools_dir)
+                        shutil.rmtree(tmp_tools_dir)
                     self.__download(tools_dir)
-            else:
-                self.__download(tools_dir)
-        else:
-            self.create_lock(tools_dir)
+            finally:
+                dl_lock.release()
 
         self.tools_dir = tools_dir
 
-    def create_lock(self, tools_dir):
-        """Create lock file inside directory with tools rootstrap."""
-
-        # remove locks created by dead processes.
-        for lock in os.listdir(tools_dir):
-            if not lock.endswith(".lock"):
-                continue
-            self.logger.debug("Checking the lock file '%s'" % lock)
-            match = re.match("\w+@([\w\.-]+)\.(\d+)\.lock", lock)
-            if match:
-                pid = int(match.group(2))
-                self.logger.debug("Checking process %d..." % pid)
-                try:
-                    os.kill(pid, 0)
-                    self.logger.debug("Living process found: %d" % pid)
-                    continue
-                except OSError, exobj:
-                    if exobj.errno == 1:
-                        self.logger.debug("Living process found: %d" % pid)
-                        continue
-                    else:
-                        self.logger.debug("OSError: %s" % exobj)
-                abslock = os.path.join(tools_dir, lock)
-
-                try:
-                    ctime = os.stat(abslock)[stat.ST_CTIME]
-                    if (time.time()) - ctime > 7200:
-                        self.logger.debug("Removing outdated lock %s" % lock)
-                        os.unlink(abslock)
-                except OSError:
-                    self.logger.error("Can't remove lock file %s "\
-                                      "of a dead process" % abslock)
-            else:
-                raise SBError("Lock doesn't match regex")
+        cache = ToolsCache(self.basedir)
+        cache.touch(tools_dir)
+        if self.cache_quota:
+            cache.prune(self.cache_quota)
+
+    def get_full_md5(self, tools_url_md5):
+        """Return md5 of <name>.full file.
+           Cached value is used if it's fresh enough or in offline mode,
+           otherwise it's revalidated with conditional request.
+        """
+
+        try:
+            os.makedirs(self.basedir)
+        except OSError, exobj:
+            if exobj.errno != errno.EEXIST:
+                raise
+        meta = ToolsMetadata(os.path.join(self.basedir,
+                                          tools_url_md5 + ".meta"))
+        meta.load()
+        if self.offline:
+            if not meta.digest:
+                raise SBError("No cached metadata for %s in offline mode" \
+                              % self.tools_url)
+            return meta.digest
+        if meta.is_fresh(self.metadata_ttl):
+            return meta.digest
+
+        url = os.path.join(self.tools_url, self.name + ".full")
+        self.logger.debug("Fetching %s" % url)
+        request = urllib2.Request(url)
+        if meta.digest:
+            if meta.etag:
+                request.add_header("If-None-Match", meta.etag)
+            if meta.last_modified:
+                request.add_header("If-Modified-Since", meta.last_modified)
+        full = None
+        try:
+            full = urllib2.urlopen(request)
+        except urllib2.HTTPError, exobj:
+            if exobj.code == 304 and meta.digest:
+                self.logger.debug("%s is not modified" % url)
+                meta.checked = time.time()
+                meta.save()
+                return meta.digest
+            # server errors are as temporary as network ones
+            if exobj.code < 500:
+                raise SBError("Can't fetch %s: %s" % (url, exobj))
+            error = exobj
+        except (urllib2.URLError, IOError), exobj:
+            error = exobj
+        if not full:
+            if meta.digest:
+                self.logger.warning("Can't fetch %s: %s, using cached "
+                                    "metadata" % (url, error))
+                return meta.digest
+            full = self.open_mirror(self.name + ".full")
+            if not full:
+                raise SBError("Can't fetch %s: %s" % (url, error))
+
+        try:
+            meta.digest = md5.md5(full.read()).hexdigest()
+            meta.etag = full.info().getheader("ETag")
+            meta.last_modified = full.info().getheader("Last-Modified")
+        finally:
+            full.close()
+        meta.checked = time.time()
+        meta.save()
+        return meta.digest
+
+    def open_mirror(self, fname):
+        """Return response of the first mirror serving fname or None."""
+
+        for mirror in self.mirrors:
+            url = os.path.join(mirror, fname)
+            self.logger.debug("Fetching %s" % url)
+            try:
+                return urllib2.urlopen(url)
+            except (urllib2.URLError, IOError), exobj:
+                self.logger.warning("Can't fetch %s: %s" % (url, exobj))
+        return None
 
-        # create symlink <user@host.pid>.lock
-        os.symlink("/dev/null", "%s/%s@%s.%d.lock" %
-                   (tools_dir, os.environ["USER"], socket.gethostname(),
-                    os.getpid()))
+    def create_lock(self, tools_dir):
+        """Take shared lock on tools rootstrap.
+           The lock is kept until remove_lock() or exit of the process.
+        """
+
+        try:
+            os.makedirs(os.path.dirname(tools_dir))
+        except OSError, exobj:
+            if exobj.errno != errno.EEXIST:
+                raise
+        self.remove_lock()
+        self.lock = FileLock(tools_dir + ".lock")
+        self.lock.acquire(exclusive=False)
 
     def remove_lock(self):
-        """Remove lock file from directory with tools rootstrap."""
+        """Release lock on tools rootstrap."""
+
+        if self.lock:
+            self.logger.debug("Releasing lock %s" % self.lock.path)
+            self.lock.release()
+            self.lock = None
+
+    def prefetch(self):
+        """Start download on background thread unless it's started.
+           Failed download is started again.
+           Return: Job, its result is path to directory with tools.
+        """
+
+        if not self.job or (self.job.done() and self.job.error):
+            self.job = Job()
+            if self.tools_dir:
+                self.job.set_result(self.tools_dir)
+            else:
+                thread = threading.Thread(target=self._prefetch)
+                thread.setDaemon(True)
+                thread.start()
+        return self.job
 
-        lock_file = "%s/%s@%s.%d.lock" % \
-            (self.tools_dir, os.environ["USER"],
-             socket.gethostname(), os.getpid())
-        self.logger.debug("Removing lock file %s" % lock_file)
-        if os.path.exists(lock_file):
-            os.unlink(lock_file)
+    def _prefetch(self):
+        """Prefetching thread."""
 
-    def get_tools_dir(self):
-        """Return path to directory with tools."""
+        try:
+            self.download()
+        except Exception, exobj:
+            self.job.set_error(exobj)
+        else:
+            self.job.set_result(self.tools_dir)
 
+    def get_tools_dir(self):
+        """Return path to directory with tools.
+           Waits for prefetch() if it was started. If prefetch failed,
+           its error is raised once and next call downloads again.
+        """
+
+        if self.job:
+            job = self.job
+            try:
+                return job.result()
+            except Exception:
+                if self.job is job:
+                    self.job = None
+                raise
         if not self.tools_dir:
             self.download()
         return self.tools_dir
@@ -209,16 +318,23 @@ class Scratchbox2(Scratchbox):
     dotdir = ".sb2-templates"
     sbdotdir = ".scratchbox2"
     sb2config = "/usr/bin/sb2-config"
+    parallel_targets = True
+    # TemplateStore used by extract_rootstrap instead of plain tar
+    template_store = None
+    # SessionPool used by setup instead of creating session per process
+    session_pool = None
 
     def __init__(self, target_name=""):
         Scratchbox.__init__(self, target_name)
         self.session = None
+        self.session_lease = None
         self.target_params = {}
         self.target = {}
         self.exe = "/usr/bin/sb2"
         self.tools_rootstrap = None
         self.logger.debug("Scratchbox2 instance created.")
 
+    @instrumented("init_target")
     def init_target(self, target_params, mode=None):
         """Init target."""
 
@@ -231,8 +347,8 @@ class Scratchbox2(Scratchbox):
         if "arch" in target_params and target_params["arch"]:
             cmdl += "-A %s " % target_params["arch"]
         if "tools" in target_params and target_params["tools"]:
-            self.tools_rootstrap = ToolsRootstrap(target_params["tools"])
-            cmdl += "-t %s " % self.tools_rootstrap.get_tools_dir()
+            cmdl += "-t %s " % \
+                    self.prefetch_tools(target_params).get_tools_dir()
 
         # there can be 2 parameters with the same meaning
         if "cputransp" in target_params and target_params["cputransp"]:
@@ -245,9 +361,38 @@ class Scratchbox2(Scratchbox):
         if "compiler" in target_params and target_params["compiler"]:
             cmdl += target_params["compiler"]
 
-        return self.run(cmdl, self.get_targetdir(), self.sb2init)
+        return self._run_direct(cmdl, self.get_targetdir(), self.sb2init)
+
+
+    def prefetch_tools(self, target_params):
+        """Start download of tools rootstrap of the target, so it runs
+           while the target is prepared. "tools_mirrors" parameter is
+           list or whitespace separated string of mirror URLs.
+           Return: ToolsRootstrap or None if target has no tools.
+        """
+
+        url = target_params.get("tools")
+        if not url:
+            return None
+        mirrors = target_params.get("tools_mirrors") or ()
+        if isinstance(mirrors, basestring):
+            mirrors = mirrors.split()
+        if not self.tools_rootstrap or self.tools_rootstrap.tools_url != url:
+            self.release_tools()
+            self.tools_rootstrap = ToolsRootstrap(url, mirrors)
+            self.tools_rootstrap.prefetch()
+        return self.tools_rootstrap
+
+    def release_tools(self):
+        """Unlock tools rootstrap, waiting for its prefetch to finish."""
 
+        if self.tools_rootstrap:
+            if self.tools_rootstrap.job:
+                self.tools_rootstrap.job.wait()
+            self.tools_rootstrap.remove_lock()
+            self.tools_rootstrap = None
 
+    @instrumented("setup")
     def setup(self, target_params, force=None):
         """Setup target."""
 
@@ -256,11 +401,19 @@ class Scratchbox2(Scratchbox):
         self.target_name = target_params["name"]
 
         targetdir = self.get_targetdir()
-        if os.path.exists(targetdir):
-            if force:
-                shutil.rmtree(targetdir)
-            else:
-                return
+        exists = os.path.exists(targetdir)
+        if exists and not force:
+            return
+
+        # download tools while the old target is removed
+        self.prefetch_tools(target_params)
+        if exists:
+            self.release_session()
+            if self.session_pool:
+                for path in self.session_pool.remove_target(self,
+                        target_params["name"]):
+                    self.logger.warning("Session %s is in use" % path)
+            shutil.rmtree(targetdir)
 
         # create the directory and symlink compat files there
         self.logger.debug("Creating template: %s" % target_params["name"])
@@ -270,6 +423,11 @@ class Scratchbox2(Scratchbox):
 
         # init target
         self.init_target(target_params, mode="devel")
+        self.get_registry().invalidate()
+
+        if self.session_pool:
+            self.lease_session("emulate", target_params.get("mappings"))
+            return ""
 
         # create session
         self.session = os.path.join(self.get_basedir(), self.sbdotdir,
@@ -280,54 +438,121 @@ class Scratchbox2(Scratchbox):
             cmdl += "-M %s " % target_params["mappings"]
         cmdl += "/bin/true"
 
-        return self.run(cmdl, directory=targetdir)
+        return self._run_direct(cmdl, directory=targetdir)
+
+    def lease_session(self, mode, mappings=None):
+        """Use session of the current target from session_pool.
+           Session is shared with other processes until release().
+        """
+
+        self.release_session()
+        self.session_lease = self.session_pool.acquire(self,
+                                 self.target_name, mode, mappings)
+        self.session = self.session_lease.path
+
+    def release_session(self):
+        """Stop using leased session."""
+
+        if self.session_lease:
+            self.session_lease.release()
+            self.session_lease = None
+            self.session = None
+
+    def get_registry(self):
+        """Returns cache of targets shared by objects of the same user."""
+        sbdir = os.path.join(self.get_basedir(), self.sbdotdir)
+        return get_registry([sbdir, os.path.join(sbdir, "config"),
+                             os.path.join(self.get_basedir(), self.dotdir)])
+
+    def _lstargets(self):
+        """List targets running sb2-config."""
+        # sb2 returns non-zero code when there are no targets found
+        (status, output) = self._run_direct("-l 2>/dev/null",
+                                            exe=self.sb2config, fatal=False)
+        if status or not output:
+            return []
+        return output.split("\n")
 
     def lstargets(self):
         """List targets."""
-        try: # sb2 returns non-zero code when there are no targets found
-            return self.run("-l 2>/dev/null", exe="sb2-config")[1].split("\n")
-        except SBError:
-            return ""
-
+        return self.get_registry().get_targets(self._lstargets)
+
+    def get_selected(self):
+        """Returns name of default target."""
+        return self.get_registry().get_selected(lambda:
+            parse_config(os.path.join(self.get_basedir(), self.sbdotdir,
+                                      "config")).get("DEFAULT_TARGET"))
+
+    def get_target_config(self, tname=None):
+        """Returns configuration of the target as dictionary."""
+        if not tname:
+            tname = self.target_name
+        return self.get_registry().get_config(tname, lambda name:
+            parse_config(os.path.join(self.get_basedir(), self.sbdotdir,
+                                      name, "sb2.config")))
+
+    @instrumented("select")
     def select(self, tname):
-        """Make target default."""
+        """Make target default. Does nothing if it's default already."""
         self.target_name = tname
-        return self.run("-d %s" % tname, self.get_targetdir(tname),
-                        self.sb2config)
+        if self.get_selected() == tname:
+            return ""
+        output = self._run_direct("-d %s" % tname,
+                                  self.get_targetdir(tname), self.sb2config)
+        self.get_registry().set_selected(tname)
+        return output
 
-    def tee(self, command, logfn, mode, bufsize=0):
-        """Tee."""
+    def get_tee_command(self, command, mode, superuser=False):
+        """Returns scratchbox arguments used by tee() to run command."""
 
+        if superuser:
+            command = "-R %s " % command
         cmdl = "-r -m %s %s " % (mode, command)
         if self.session:
             cmdl = "-J %s %s" % (self.session, cmdl)
-        return self._tee(cmdl, logfn, bufsize)
+        elif self.target_name:
+            cmdl = "-t %s %s" % (self.target_name, cmdl)
+        return cmdl
+
+    def tee(self, command, logfn, mode, bufsize=0, compress=None, tail=0,
+            timeout=None, consumers=None):
+        """Tee."""
+        return self._tee(self.get_tee_command(command, mode), logfn, bufsize,
+                         compress, tail, timeout, consumers)
 
     def remove(self, tname):
         """Remove target."""
 
         self.logger.debug("Removing target '%s'" % tname)
         # remove session
-        if self.session:
-            self.run("-D %s" % self.session)
+        if self.session_lease:
+            self.release_session()
+        elif self.session:
+            self._run_direct("-D %s" % self.session)
+        if self.session_pool:
+            for path in self.session_pool.remove_target(self, tname):
+                self.logger.warning("Session %s is in use" % path)
 
         # remove target itself and target configuration dirs
         for sdir in (self.dotdir, self.sbdotdir):
             tdir = os.path.join(self.get_basedir(), sdir, tname)
             if os.path.exists(tdir):
                 shutil.rmtree(tdir)
+        self.get_registry().invalidate()
 
-    def superuser_tee(self, command, logfn, mode, bufsize=0):
+    def superuser_tee(self, command, logfn, mode, bufsize=0, compress=None,
+                      tail=0, timeout=None, consumers=None):
         """Run command with root privileges."""
 
-        cmdl = "-R %s " % command
-        return self.tee(cmdl, logfn, mode, bufsize)
+        return self._tee(self.get_tee_command(command, mode, True),
+                         logfn, bufsize, compress, tail, timeout, consumers)
 
     def release(self):
         """Release acquired resources."""
 
-        if self.tools_rootstrap:
-            self.tools_rootstrap.remove_lock()
+        Scratchbox.release(self)
+        self.release_session()
+        self.release_tools()
 
     def get_basedir(self):
         """Returns absolute path to scratchbox base directory."""
@@ -348,6 +573,16 @@ class Scratchbox2(Scratchbox):
         return os.path.join(self.get_basedir(), self.dotdir,
                             self.target_name, "tmp")
 
+    def get_host_path(self, sb_path):
+        """Returns host path of the path inside scratchbox.
+           Home and /tmp are the same as on the host, other absolute paths
+           are in target root, relative ones are relative to the target.
+        """
+        for prefix in (self.get_basedir(), "/tmp"):
+            if sb_path == prefix or sb_path.startswith(prefix + os.sep):
+                return sb_path
+        return os.path.join(self.get_targetdir(), sb_path.lstrip(os.sep))
+
     def get_sb_tmpdir(self):
         """Returns path to temporary directory inside scratchbox."""
         return "tmp"
@@ -370,13 +605,17 @@ class Scratchbox2(Scratchbox):
         else:
             raise SBError("Unknown mode %s" % mode)
 
+    @instrumented("extract_rootstrap")
     def extract_rootstrap(self, rootstrap):
         """Extracts given local rootstrap into target."""
 
-        cmd = "tar zxf %s" % rootstrap
-        self.logger.debug("Executing the command: %s" % cmd)
-        output = run_command(cmd, self.get_targetdir(self.target_name))
-        self.logger.debug("Return status tar: \n%s" % output)
+        if self.template_store:
+            self.template_store.materialize(rootstrap, self.get_targetdir())
+        else:
+            cmd = "tar zxf %s" % rootstrap
+            self.logger.debug("Executing the command: %s" % cmd)
+            output = run_command(cmd, self.get_targetdir(self.target_name))
+            self.logger.debug("Return status tar: \n%s" % output)
         os.symlink(self.sb1compat_dir, os.path.join(self.get_targetdir(\
             self.target_name), os.path.basename(self.sb1compat_dir)))
 
@@ -388,6 +627,7 @@ class Scratchbox2(Scratchbox):
         """Creates target."""
         self.target_name = name
         self.target_params = params
+        self.prefetch_tools(params)
         self.logger.debug("No need to create target. In SB2 target is "\
                           "initialised after rootstrap is unpacked.")
 
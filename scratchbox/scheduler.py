@@ -0,0 +1,161 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Parallel multi-target build scheduler.
+"""
+
+import os
+import threading
+import logging
+
+from scratchbox import scratchbox_factory
+
+class BuildJob(object):
+    """Command to be run in a target by tee() or superuser_tee().
+       consumers get output of the command as it comes.
+    """
+
+    def __init__(self, target, command, mode, logfn, superuser=False,
+                 consumers=None):
+        self.target = target
+        self.command = command
+        self.mode = mode
+        self.logfn = logfn
+        self.superuser = superuser
+        self.consumers = consumers
+        self.status = None
+        self.error = None
+
+class BuildScheduler(object):
+    """Runs build jobs on a bounded pool of worker threads.
+
+       Jobs for the same target never run at the same time. If scratchbox
+       can't use several targets at once (scratchbox1 has only one
+       selected target) all jobs are run one by one.
+    """
+
+    def __init__(self, sbver=1, workers=None):
+        if not workers:
+            workers = os.sysconf("SC_NPROCESSORS_ONLN")
+        self.sbver = sbver
+        self.workers = workers
+        self.instances = {}
+        self.pending = []
+        self.busy = set()
+        self.cond = threading.Condition()
+        self.logger = logging.getLogger(__name__)
+
+    def create_instance(self, target):
+        """Create scratchbox object for the target."""
+        sbox = scratchbox_factory(self.sbver)
+        sbox.set_target_name(target)
+        return sbox
+
+    def get_instance(self, target):
+        """Return scratchbox object used for the target."""
+
+        self.cond.acquire()
+        try:
+            if target not in self.instances:
+                self.instances[target] = self.create_instance(target)
+            return self.instances[target]
+        finally:
+            self.cond.release()
+
+    def get_key(self, job):
+        """Return exclusivity key of the job."""
+
+        if self.get_instance(job.target).parallel_targets:
+            return job.target
+        return None
+
+    def run(self, jobs):
+        """Run jobs.
+           Return: list of exit codes in the same order as jobs.
+        """
+
+        self.pending = [(self.get_key(job), job) for job in jobs]
+        threads = []
+        for _ in range(min(self.workers, len(self.pending))):
+            thread = threading.Thread(target=self.worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return [job.status for job in jobs]
+
+    def next_job(self):
+        """Take next job which target is not busy.
+           Return: (key, job) or None when there are no jobs left.
+        """
+
+        self.cond.acquire()
+        try:
+            while self.pending:
+                for item in self.pending:
+                    if item[0] not in self.busy:
+                        self.pending.remove(item)
+                        self.busy.add(item[0])
+                        return item
+                self.cond.wait()
+            return None
+        finally:
+            self.cond.release()
+
+    def worker(self):
+        """Worker thread."""
+
+        while True:
+            item = self.next_job()
+            if not item:
+                break
+            key, job = item
+            try:
+                self.run_job(job)
+            finally:
+                self.cond.acquire()
+                self.busy.remove(key)
+                self.cond.notifyAll()
+                self.cond.release()
+
+    def run_job(self, job):
+        """Run one job and store its exit code."""
+
+        sbox = self.get_instance(job.target)
+        self.logger.debug("running job on %s: %s" % (job.target, job.command))
+        try:
+            if not sbox.parallel_targets:
+                sbox.select(job.target)
+            if job.superuser:
+                job.status = sbox.superuser_tee(job.command, job.logfn,
+                                                job.mode,
+                                                consumers=job.consumers)
+            else:
+                job.status = sbox.tee(job.command, job.logfn, job.mode,
+                                      consumers=job.consumers)
+        except Exception, exobj:
+            self.logger.error("job on %s failed: %s" % (job.target, exobj))
+            job.error = exobj
+            job.status = -1
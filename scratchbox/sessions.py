@@ -0,0 +1,200 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Pool of scratchbox2 sessions.
+
+Prepared sessions are kept as <basedir>/<target>.<key md5> where key is
+(target, mode, mappings). Next to every session there are:
+    <session>.lock  - flock()ed shared by lease holders, exclusively
+                      by the process which removes session
+    <session>.create.lock - flock()ed exclusively while session is created
+    <session>.ready - session is completely created
+    <session>.used  - mtime is the time of the last lease
+
+Leases are shared locks, so the kernel releases leases of crashed
+processes and the session becomes idle again.
+"""
+
+import os
+import errno
+import time
+import shutil
+import md5
+import logging
+
+from scratchbox.locking import FileLock
+
+def _touch(path):
+    """Create file or update its mtime."""
+    open(path, "a").close()
+    os.utime(path, None)
+
+def _unlink(path):
+    """Remove file if it exists."""
+    try:
+        os.unlink(path)
+    except OSError, exobj:
+        if exobj.errno != errno.ENOENT:
+            raise
+
+class SessionLease(object):
+    """Session used by this process until release()."""
+
+    def __init__(self, pool, path, lock):
+        self.pool = pool
+        self.path = path
+        self.lock = lock
+
+    def release(self):
+        """Stop using the session. It's kept in the pool for others."""
+        if self.lock:
+            self.lock.release()
+            self.lock = None
+            self.pool.logger.debug("Released session %s" % self.path)
+
+class SessionPool(object):
+    """Sessions shared by builders running in the same targets."""
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.logger = logging.getLogger(__name__)
+
+    def get_path(self, target, mode, mappings=None):
+        """Return path to session of the target with given options."""
+        key = md5.md5("%s\0%s\0%s" % (target, mode, mappings or "")) \
+                 .hexdigest()
+        return os.path.join(self.basedir, "%s.%s" % (target, key))
+
+    def create(self, sbox, path, target, mode, mappings):
+        """Create session running /bin/true in it."""
+
+        if os.path.exists(path):
+            # nobody else holds the lock: it's left by dead process
+            self.logger.debug("Removing unfinished session %s" % path)
+            shutil.rmtree(path)
+        cmdl = "-m %s -c -t %s -S %s " % (mode, target, path)
+        if mappings:
+            cmdl += "-M %s " % mappings
+        cmdl += "/bin/true"
+        self.logger.debug("Creating session %s" % path)
+        sbox._run_direct(cmdl, directory=sbox.get_targetdir(target))
+        _touch(path + ".ready")
+
+    def acquire(self, sbox, target, mode, mappings=None):
+        """Lease session, creating it if there is no session yet.
+           Return: SessionLease.
+        """
+
+        try:
+            os.makedirs(self.basedir)
+        except OSError, exobj:
+            if exobj.errno != errno.EEXIST:
+                raise
+        path = self.get_path(target, mode, mappings)
+        lock = FileLock(path + ".lock")
+        lock.acquire(exclusive=False)
+        try:
+            if not os.path.exists(path + ".ready"):
+                # only one process creates the session, others wait on
+                # creation lock; the lease lock stays shared, converting
+                # it would wait until other leases are released
+                create_lock = FileLock(path + ".create.lock")
+                create_lock.acquire(exclusive=True)
+                try:
+                    if not os.path.exists(path + ".ready"):
+                        self.create(sbox, path, target, mode, mappings)
+                finally:
+                    create_lock.release()
+        except:
+            lock.release()
+            raise
+        _touch(path + ".used")
+        self.logger.debug("Leased session %s" % path)
+        return SessionLease(self, path, lock)
+
+    def sessions(self, target=None):
+        """Return paths of ready sessions, of the target if given."""
+
+        if not os.path.isdir(self.basedir):
+            return []
+        result = []
+        for name in sorted(os.listdir(self.basedir)):
+            if not name.endswith(".ready"):
+                continue
+            name = name[:-len(".ready")]
+            if target is None or name.rsplit(".", 1)[0] == target:
+                result.append(os.path.join(self.basedir, name))
+        return result
+
+    def get_last_used(self, path):
+        """Return time of the last lease of the session."""
+        try:
+            return os.stat(path + ".used").st_mtime
+        except OSError:
+            return 0
+
+    def remove(self, sbox, path):
+        """Remove session unless somebody is using it.
+           Return: False if the session is in use.
+        """
+
+        lock = FileLock(path + ".lock")
+        if not lock.acquire(exclusive=True, blocking=False):
+            return False
+        try:
+            self.logger.debug("Removing session %s" % path)
+            _unlink(path + ".ready")
+            if os.path.exists(path):
+                sbox._run_direct("-D %s" % path, fatal=False)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            _unlink(path + ".used")
+        finally:
+            # lock file is kept: somebody can be waiting on it already
+            lock.release()
+        return True
+
+    def remove_target(self, sbox, target):
+        """Remove idle sessions of the target.
+           Return: list of sessions which are still in use.
+        """
+
+        busy = []
+        for path in self.sessions(target):
+            if not self.remove(sbox, path):
+                busy.append(path)
+        return busy
+
+    def prune(self, sbox, max_idle):
+        """Remove sessions not leased for max_idle seconds.
+           Return: list of removed sessions.
+        """
+
+        removed = []
+        now = time.time()
+        for path in self.sessions():
+            if now - self.get_last_used(path) >= max_idle and \
+               self.remove(sbox, path):
+                removed.append(path)
+        return removed
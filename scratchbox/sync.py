@@ -0,0 +1,234 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Delta synchronization of directory trees.
+
+Only new files and files with different size or mtime are copied;
+with verify set, files which look the same are compared by md5 too.
+Copied files get mode and times of the source, so they are skipped by
+the next sync. Data is copied by the kernel with copy_file_range() or
+sendfile() when libc provides them, and files can be hardlinked when
+both trees are on the same filesystem.
+"""
+
+import os
+import stat
+import errno
+import shutil
+import logging
+
+from scratchbox.manifest import file_md5
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except (ImportError, OSError, TypeError):
+    _libc = None
+
+_copy_file_range = getattr(_libc, "copy_file_range", None)
+_sendfile = getattr(_libc, "sendfile", None)
+if _copy_file_range:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_uint)
+if _sendfile:
+    _sendfile.restype = ctypes.c_ssize_t
+    _sendfile.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t)
+
+CHUNK_SIZE = 1 << 20
+# mtime set by utime() can be rounded by filesystem
+MTIME_SLACK = 0.001
+
+def _kernel_copy(func, infd, outfd, size):
+    """Copy size bytes with copy_file_range or sendfile.
+       Return: False if the call is not supported for these files.
+    """
+
+    done = 0
+    while done < size:
+        if func is _copy_file_range:
+            count = func(infd, None, outfd, None,
+                         min(size - done, 1 << 30), 0)
+        else:
+            count = func(outfd, infd, None, min(size - done, 1 << 30))
+        if count < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if done == 0 and err in (errno.ENOSYS, errno.EXDEV,
+                                     errno.EINVAL, errno.EOPNOTSUPP):
+                return False
+            raise OSError(err, os.strerror(err))
+        if count == 0:
+            break
+        done += count
+    return True
+
+def copy_data(src, dst):
+    """Copy contents of file src to new file dst."""
+
+    infd = os.open(src, os.O_RDONLY)
+    try:
+        outfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            size = os.fstat(infd).st_size
+            for func in (_copy_file_range, _sendfile):
+                if func and _kernel_copy(func, infd, outfd, size):
+                    return
+            while True:
+                data = os.read(infd, CHUNK_SIZE)
+                if not data:
+                    break
+                while data:
+                    data = data[os.write(outfd, data):]
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+class SyncStats(object):
+    """Outcome of sync_tree()."""
+
+    def __init__(self):
+        self.copied = 0
+        self.linked = 0
+        self.skipped = 0
+        self.removed = 0
+        self.nbytes = 0
+
+    def __repr__(self):
+        return "<SyncStats copied=%d linked=%d skipped=%d removed=%d " \
+               "bytes=%d>" % (self.copied, self.linked, self.skipped,
+                              self.removed, self.nbytes)
+
+def _same(sstat, dstat, src, dst, verify):
+    """Check if destination file is up to date."""
+
+    if not stat.S_ISREG(dstat.st_mode) or sstat.st_size != dstat.st_size \
+       or abs(sstat.st_mtime - dstat.st_mtime) > MTIME_SLACK:
+        return False
+    if (sstat.st_dev, sstat.st_ino) == (dstat.st_dev, dstat.st_ino):
+        return True
+    if verify:
+        return file_md5(src) == file_md5(dst)
+    return True
+
+def _remove(path):
+    """Remove file or directory tree."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def sync_tree(src, dst, verify=False, delete=False, link=False):
+    """Make directory tree dst a copy of src transferring only changes.
+       verify: compare contents of files with equal size and mtime.
+       delete: remove entries of dst which are not in src.
+       link: hardlink files instead of copying them if possible. Linked
+       files share contents, changes of one are seen in the other.
+       Return: SyncStats.
+    """
+
+    logger = logging.getLogger(__name__)
+    if not os.path.isdir(src):
+        raise OSError(errno.ENOENT, "No such directory", src)
+    stats = SyncStats()
+    dirs = []
+    for root, dirnames, filenames in os.walk(src):
+        target = os.path.join(dst, root[len(src):].lstrip(os.sep))
+        if not os.path.isdir(target):
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.makedirs(target)
+        dirs.append((root, target))
+
+        if delete:
+            names = set(dirnames + filenames)
+            for name in os.listdir(target):
+                if name not in names:
+                    _remove(os.path.join(target, name))
+                    stats.removed += 1
+
+        for name in filenames + [name for name in dirnames
+                                 if os.path.islink(os.path.join(root, name))]:
+            spath = os.path.join(root, name)
+            dpath = os.path.join(target, name)
+            sstat = os.lstat(spath)
+            try:
+                dstat = os.lstat(dpath)
+            except OSError:
+                dstat = None
+
+            if stat.S_ISLNK(sstat.st_mode):
+                linkto = os.readlink(spath)
+                if dstat and stat.S_ISLNK(dstat.st_mode) and \
+                   os.readlink(dpath) == linkto:
+                    stats.skipped += 1
+                    continue
+                if dstat:
+                    _remove(dpath)
+                os.symlink(linkto, dpath)
+                stats.copied += 1
+                continue
+            if not stat.S_ISREG(sstat.st_mode):
+                logger.debug("Skipping special file %s" % spath)
+                continue
+            if dstat and _same(sstat, dstat, spath, dpath, verify):
+                stats.skipped += 1
+                continue
+
+            # new content is put in place atomically
+            tmpname = os.path.join(target, ".%s.sbsync" % name)
+            if os.path.lexists(tmpname):
+                os.unlink(tmpname)
+            linked = False
+            if link:
+                try:
+                    os.link(spath, tmpname)
+                    linked = True
+                except OSError, exobj:
+                    if exobj.errno not in (errno.EXDEV, errno.EPERM,
+                                           errno.EMLINK):
+                        raise
+            if not linked:
+                copy_data(spath, tmpname)
+                shutil.copystat(spath, tmpname)
+            if dstat and stat.S_ISDIR(dstat.st_mode):
+                shutil.rmtree(dpath)
+            os.rename(tmpname, dpath)
+            if linked:
+                stats.linked += 1
+            else:
+                stats.copied += 1
+                stats.nbytes += sstat.st_size
+
+    # copying files changes directory times, so restore them last
+    dirs.reverse()
+    for root, target in dirs:
+        shutil.copystat(root, target)
+    logger.debug("Synced %s to %s: %r" % (src, dst, stats))
+    return stats
@@ -0,0 +1,145 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Pristine rootstrap templates.
+
+Every distinct rootstrap tarball is extracted only once into the
+template store. Targets are created by cloning the template: with
+reflinks (copy-on-write) if the filesystem supports them, otherwise by
+plain copy, which still saves decompression and extraction of the
+tarball. Hard links are not used: targets would share inodes with the
+template, so chmod or in-place write in one target would change the
+template and all other targets.
+"""
+
+import os
+import errno
+import shutil
+import logging
+import md5
+
+from scratchbox.common import SBError, run_command, shell_quote
+from scratchbox.locking import FileLock
+
+_reflink_support = {}
+
+def reflink_supported(path):
+    """Check if filesystem of directory path supports reflinks."""
+
+    dev = os.stat(path).st_dev
+    if dev not in _reflink_support:
+        probe = os.path.join(path, ".reflink-probe.%d" % os.getpid())
+        open(probe, "w").write("probe")
+        status, _ = run_command("cp --reflink=always %s %s.copy" % \
+                                (shell_quote(probe), shell_quote(probe)),
+                                fatal=False)
+        for fname in (probe, probe + ".copy"):
+            if os.path.exists(fname):
+                os.unlink(fname)
+        _reflink_support[dev] = not status
+    return _reflink_support[dev]
+
+def clone_tree(src, dst):
+    """Clone directory tree src into dst.
+       Return: "reflink" or "copy" depending on the method used.
+    """
+
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    if reflink_supported(dst):
+        run_command("cp -a --reflink=always %s/. %s" % \
+                    (shell_quote(src), shell_quote(dst)))
+        return "reflink"
+    run_command("cp -a %s/. %s" % (shell_quote(src), shell_quote(dst)))
+    return "copy"
+
+class TemplateStore(object):
+    """Extracted rootstraps shared by targets.
+       Store must be on the same filesystem as targets to use reflinks.
+    """
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.logger = logging.getLogger(__name__)
+
+    def get_key(self, rootstrap):
+        """Return identity of rootstrap tarball."""
+
+        rootstrap = os.path.abspath(rootstrap)
+        rstat = os.stat(rootstrap)
+        return md5.md5("%s:%d:%d" % (rootstrap, rstat.st_size,
+                                     rstat.st_mtime)).hexdigest()
+
+    def get_template(self, rootstrap):
+        """Return path to template of rootstrap. Extract it if needed."""
+
+        template = os.path.join(self.basedir, self.get_key(rootstrap))
+        if os.path.isdir(template):
+            return template
+
+        try:
+            os.makedirs(self.basedir)
+        except OSError, exobj:
+            if exobj.errno != errno.EEXIST:
+                raise
+        lock = FileLock(template + ".lock")
+        lock.acquire(exclusive=True)
+        try:
+            if not os.path.isdir(template):
+                self.extract(rootstrap, template)
+        finally:
+            lock.release()
+        return template
+
+    def extract(self, rootstrap, template):
+        """Extract rootstrap into new template."""
+
+        tmpdir = template + ".tmp"
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        self.logger.debug("Extracting template %s from %s" % \
+                          (template, rootstrap))
+        run_command("tar zxf %s" % shell_quote(os.path.abspath(rootstrap)),
+                    tmpdir)
+        os.rename(tmpdir, template)
+
+    def materialize(self, rootstrap, targetdir):
+        """Create target contents from rootstrap template.
+           Return: clone method used.
+        """
+
+        template = self.get_template(rootstrap)
+        method = clone_tree(template, targetdir)
+        self.logger.debug("Cloned %s into %s using %s" % \
+                          (template, targetdir, method))
+        return method
+
+    def remove(self, rootstrap):
+        """Remove template of rootstrap."""
+
+        template = os.path.join(self.basedir, self.get_key(rootstrap))
+        if not os.path.isdir(template):
+            raise SBError("No template for %s" % rootstrap)
+        shutil.rmtree(template)
@@ -0,0 +1,312 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Scratchbox API. Cache of downloaded tools rootstraps.
+
+Tools rootstraps are stored as <basedir>/<url md5>/<.full md5>.
+Every entry can have sidecar files next to it:
+    <entry>.used   - mtime is the time of the last use
+    <entry>.size   - disk usage of the entry in bytes
+    <entry>.pinned - entry is never evicted
+    <entry>.lock   - flock()ed shared by users, exclusively by remover
+    <entry>.dl.lock - flock()ed exclusively while the entry is downloaded
+
+Digest of the .full manifest of every tools URL is kept in
+<basedir>/<url md5>.meta together with HTTP validators.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+
+from optparse import OptionParser
+from ConfigParser import RawConfigParser, Error as ConfigError
+
+from scratchbox.common import SBError
+from scratchbox.locking import FileLock, is_busy
+
+def dir_size(path):
+    """Return disk usage of the directory tree in bytes."""
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def parse_size(size):
+    """Convert size like 512M or 20G to bytes."""
+
+    size = str(size).strip().upper()
+    mult = 1
+    for suffix, value in (("K", 1 << 10), ("M", 1 << 20), ("G", 1 << 30),
+                          ("T", 1 << 40)):
+        if size.endswith(suffix):
+            size = size[:-1]
+            mult = value
+            break
+    try:
+        return int(float(size) * mult)
+    except ValueError:
+        raise SBError("Wrong size: %s" % size)
+
+class CacheEntry(object):
+    """Tools rootstrap stored in the cache."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.join(*path.split(os.sep)[-2:])
+
+    def get_size(self):
+        """Return size of the entry, calculating it once."""
+
+        try:
+            return int(open(self.path + ".size").read())
+        except (IOError, ValueError):
+            size = dir_size(self.path)
+            try:
+                open(self.path + ".size", "w").write("%d\n" % size)
+            except IOError:
+                pass
+            return size
+
+    def get_last_used(self):
+        """Return time of the last use of the entry."""
+
+        times = [os.stat(self.path).st_mtime]
+        if os.path.exists(self.path + ".used"):
+            times.append(os.stat(self.path + ".used").st_mtime)
+        return max(times)
+
+    def is_pinned(self):
+        """Return True if entry must never be evicted."""
+        return os.path.exists(self.path + ".pinned")
+
+    def in_use(self):
+        """Return True if a living process holds the entry."""
+        return is_busy(self.path + ".lock")
+
+class ToolsMetadata(object):
+    """Cached digest of tools rootstrap .full manifest."""
+
+    section = "metadata"
+    fields = ("digest", "etag", "last_modified", "checked")
+
+    def __init__(self, path):
+        self.path = path
+        self.digest = None
+        self.etag = None
+        self.last_modified = None
+        self.checked = 0.0
+
+    def load(self):
+        """Load metadata. Missing or broken file means empty metadata."""
+
+        parser = RawConfigParser()
+        try:
+            parser.read(self.path)
+            for field in self.fields:
+                if parser.has_option(self.section, field):
+                    setattr(self, field, parser.get(self.section, field))
+            self.checked = float(self.checked)
+        except (ConfigError, ValueError):
+            self.digest = None
+            self.checked = 0.0
+
+    def save(self):
+        """Save metadata atomically."""
+
+        parser = RawConfigParser()
+        parser.add_section(self.section)
+        for field in self.fields:
+            value = getattr(self, field)
+            if value is not None:
+                parser.set(self.section, field, value)
+        tmpname = "%s.%d" % (self.path, os.getpid())
+        tmpfile = open(tmpname, "w")
+        try:
+            parser.write(tmpfile)
+        finally:
+            tmpfile.close()
+        os.rename(tmpname, self.path)
+
+    def is_fresh(self, ttl):
+        """Return True if digest was validated less than ttl seconds ago."""
+        return self.digest and time.time() - self.checked < ttl
+
+class ToolsCache(object):
+    """Manages size of the tools rootstraps directory.
+       Least recently used entries are evicted first, entries held by
+       living processes and pinned ones are never evicted.
+    """
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.logger = logging.getLogger(__name__)
+
+    def entries(self):
+        """Return list of cache entries."""
+
+        result = []
+        if not os.path.isdir(self.basedir):
+            return result
+        for url_md5 in os.listdir(self.basedir):
+            url_dir = os.path.join(self.basedir, url_md5)
+            if not os.path.isdir(url_dir):
+                continue
+            for name in os.listdir(url_dir):
+                path = os.path.join(url_dir, name)
+                if "." not in name and os.path.isdir(path):
+                    result.append(CacheEntry(path))
+        return result
+
+    def get_entry(self, name):
+        """Return entry by path or <url md5>/<full md5> name."""
+
+        path = name
+        if not os.path.isabs(path):
+            path = os.path.join(self.basedir, name)
+        if not os.path.isdir(path):
+            raise SBError("No such cache entry: %s" % name)
+        return CacheEntry(os.path.normpath(path))
+
+    def touch(self, path):
+        """Mark entry as used now."""
+
+        try:
+            open(path + ".used", "a").close()
+            os.utime(path + ".used", None)
+        except (IOError, OSError), exobj:
+            self.logger.debug("Can't update usage of %s: %s" % (path, exobj))
+
+    def pin(self, name):
+        """Protect entry from eviction."""
+        open(self.get_entry(name).path + ".pinned", "w").close()
+
+    def unpin(self, name):
+        """Allow entry to be evicted."""
+        pinned = self.get_entry(name).path + ".pinned"
+        if os.path.exists(pinned):
+            os.unlink(pinned)
+
+    def get_size(self):
+        """Return total size of the cache in bytes."""
+        return sum([entry.get_size() for entry in self.entries()])
+
+    def remove(self, entry):
+        """Remove entry unless it's in use.
+           Return: True if entry was removed.
+        """
+
+        # users take shared lock before checking that entry exists,
+        # so holding exclusive lock makes removal safe
+        lock = FileLock(entry.path + ".lock")
+        if not lock.acquire(exclusive=True, blocking=False):
+            return False
+        # move entry away first, half-removed entry must not be used
+        trash = "%s.evict.%d" % (entry.path, os.getpid())
+        os.rename(entry.path, trash)
+        self.logger.debug("Evicting tools rootstrap %s" % entry.path)
+        shutil.rmtree(trash)
+        # lock file is kept: somebody can be waiting on it already
+        for suffix in (".used", ".size"):
+            if os.path.exists(entry.path + suffix):
+                os.unlink(entry.path + suffix)
+        lock.release()
+        return True
+
+    def prune(self, quota):
+        """Evict least recently used entries until cache fits in quota.
+           Return: list of removed entries.
+        """
+
+        entries = [(entry.get_last_used(), entry) for entry in self.entries()]
+        entries.sort()
+        total = sum([entry.get_size() for _, entry in entries])
+        removed = []
+        for _, entry in entries:
+            if total <= quota:
+                break
+            if entry.is_pinned() or entry.in_use():
+                continue
+            size = entry.get_size()
+            if self.remove(entry):
+                total -= size
+                removed.append(entry)
+        if total > quota:
+            self.logger.warning("Tools cache %s uses %d bytes, quota is %d" \
+                                % (self.basedir, total, quota))
+        return removed
+
+def main(argv=None):
+    """Command line interface: list, pin, unpin and prune entries."""
+
+    from scratchbox.sb2 import ToolsRootstrap
+
+    parser = OptionParser(usage="%prog [options] list|pin|unpin|prune "
+                                "[entry...]")
+    parser.add_option("-b", "--basedir", default=ToolsRootstrap.basedir,
+                      help="tools rootstraps directory [%default]")
+    parser.add_option("-q", "--quota",
+                      help="cache size limit for prune, e.g. 20G")
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("no command given")
+
+    cache = ToolsCache(options.basedir)
+    command = args[0]
+    try:
+        if command == "list":
+            for entry in cache.entries():
+                flags = ""
+                if entry.is_pinned():
+                    flags += "P"
+                if entry.in_use():
+                    flags += "U"
+                print "%-70s %12d %s %s" % (entry.name, entry.get_size(),
+                    time.strftime("%Y-%m-%d %H:%M",
+                                  time.localtime(entry.get_last_used())),
+                    flags)
+        elif command in ("pin", "unpin"):
+            for name in args[1:]:
+                getattr(cache, command)(name)
+        elif command == "prune":
+            if not options.quota:
+                parser.error("prune requires --quota")
+            for entry in cache.prune(parse_size(options.quota)):
+                print "removed %s" % entry.name
+        else:
+            parser.error("unknown command %s" % command)
+    except SBError, exobj:
+        print >> sys.stderr, exobj
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Tests of target checkpoints.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from scratchbox.checkpoint import Checkpoint
+
+class CheckpointTest(unittest.TestCase):
+    """Checkpoint.create() and restore() on a small tree."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpdir, "target")
+        os.makedirs(os.path.join(self.target, "etc"))
+        self.write("etc/log", "first\n")
+        self.write("etc/config", "a=1\n")
+        self.checkpoint = Checkpoint(self.target,
+                                     os.path.join(self.tmpdir, "checkpoint"))
+        self.checkpoint.create()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, data, mode="w"):
+        """Write data to file of the target."""
+        ofile = open(os.path.join(self.target, path), mode)
+        try:
+            ofile.write(data)
+        finally:
+            ofile.close()
+
+    def read(self, path):
+        """Return contents of file of the target."""
+        return open(os.path.join(self.target, path)).read()
+
+    def test_append_in_place(self):
+        """File appended in place is restored, checkpoint is intact."""
+
+        self.write("etc/log", "second\n", "a")
+        self.checkpoint.restore()
+        self.assertEqual(self.read("etc/log"), "first\n")
+        self.write("etc/log", "third\n", "a")
+        self.checkpoint.restore()
+        self.assertEqual(self.read("etc/log"), "first\n")
+
+    def test_new_and_removed(self):
+        """New files are removed, removed files are restored."""
+
+        self.write("etc/new", "new\n")
+        os.unlink(os.path.join(self.target, "etc", "config"))
+        self.checkpoint.restore()
+        self.assertFalse(os.path.exists(os.path.join(self.target, "etc",
+                                                     "new")))
+        self.assertEqual(self.read("etc/config"), "a=1\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Tests of rootstrap downloads: resume, mirrors and fallback of streaming.
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bench"))
+
+from server import make_tools, RootstrapServer
+from scratchbox.common import SBError
+from scratchbox.download import SegmentedDownload
+from scratchbox.sb2 import ToolsRootstrap
+
+# nobody listens there
+DEAD_URL = "http://127.0.0.1:1/file"
+
+class FailingDownload(SegmentedDownload):
+    """Download which dies after the first segments, like a crash."""
+
+    def fetch_segment(self, index):
+        if index >= 2:
+            raise SBError("crash")
+        SegmentedDownload.fetch_segment(self, index)
+
+class ListHandler(logging.Handler):
+    """Keeps messages of log records."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class DownloadTest(unittest.TestCase):
+    """Downloads from local HTTP servers."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.docroot = os.path.join(self.tmpdir, "www")
+        os.makedirs(self.docroot)
+        self.data = os.urandom(100000)
+        open(os.path.join(self.docroot, "file"), "wb").write(self.data)
+        self.servers = []
+        self.basedir = ToolsRootstrap.basedir
+
+    def tearDown(self):
+        ToolsRootstrap.basedir = self.basedir
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def start_server(self, break_after=None):
+        """Serve docroot, breaking responses after break_after bytes."""
+
+        server = RootstrapServer(self.docroot, break_after=break_after)
+        server.start()
+        self.servers.append(server)
+        return server
+
+    def path(self, name):
+        """Return path in temporary directory."""
+        return os.path.join(self.tmpdir, name)
+
+    def test_broken_connections(self):
+        """Segments interrupted by the server are continued."""
+
+        server = self.start_server(break_after=7000)
+        download = SegmentedDownload(server.url("/file"), self.path("out"))
+        download.segment_size = 16384
+        self.assertEqual(open(download.run(), "rb").read(), self.data)
+
+    def test_resume(self):
+        """Download interrupted by a crash continues from saved state."""
+
+        server = self.start_server()
+        download = FailingDownload(server.url("/file"), self.path("out"), 1)
+        download.segment_size = 16384
+        self.assertRaises(SBError, download.run)
+        self.assertFalse(os.path.exists(self.path("out")))
+
+        download = SegmentedDownload(server.url("/file"), self.path("out"))
+        download.segment_size = 16384
+        self.assertEqual(open(download.run(), "rb").read(), self.data)
+        self.assertEqual(download.nbytes, len(self.data) - 2 * 16384)
+
+    def test_mirrors(self):
+        """Mirror is used if the first URL doesn't answer."""
+
+        server = self.start_server()
+        download = SegmentedDownload([DEAD_URL, server.url("/file")],
+                                     self.path("out"))
+        self.assertEqual(open(download.run(), "rb").read(), self.data)
+
+    def test_streaming_fallback(self):
+        """Failed streaming is replaced by segmented download."""
+
+        path = make_tools(self.docroot, nfiles=20)
+        server = self.start_server(break_after=4000)
+        ToolsRootstrap.basedir = self.path("cache")
+        rootstrap = ToolsRootstrap(server.url(path))
+        handler = ListHandler()
+        rootstrap.logger.addHandler(handler)
+        try:
+            tools_dir = rootstrap.get_tools_dir()
+        finally:
+            rootstrap.logger.removeHandler(handler)
+            rootstrap.remove_lock()
+        self.assertTrue([message for message in handler.messages
+                         if message.startswith("Streaming tools failed")])
+        self.assertEqual(len(os.listdir(os.path.join(tools_dir, "usr",
+                                                     "lib"))), 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python -tt
+# vim: sw=4 ts=4 expandtab ai
+#
+# python-scratchbox - python API for scratchbox
+#
+# Copyright (C) 2006-2009 Ed Bartosh <bartosh@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301 USA
+#
+
+"""
+Tests of the command server of scratchbox objects.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bench"))
+
+from run import Environment
+from scratchbox.sessions import SessionPool
+
+class CommandServerTest(unittest.TestCase):
+    """Scratchbox2 with started command server, using bench/fake-sb."""
+
+    def setUp(self):
+        self.env = Environment()
+        self.sbox = self.env.sb2()
+        self.sbox.start_server()
+
+    def tearDown(self):
+        self.sbox.stop_server()
+        self.env.cleanup()
+
+    def test_run(self):
+        """Commands of the caller go to the server."""
+        self.assertEqual(self.sbox.run("echo $((1 + 2))"), "3")
+        self.assertEqual(self.sbox.run("pwd", directory="/"), "/")
+
+    def test_setup_remove(self):
+        """Sandbox control doesn't go to the server."""
+
+        self.sbox.setup({"name": "bench"})
+        self.assertTrue(os.path.isdir(self.sbox.get_targetdir()))
+        self.sbox.remove("bench")
+        self.assertFalse(os.path.exists(self.sbox.get_targetdir()))
+        self.assertEqual(self.sbox.run("echo ok"), "ok")
+
+    def test_setup_existing(self):
+        """Setup of existing target doesn't download tools."""
+
+        self.sbox.setup({"name": "bench"})
+        self.sbox.setup({"name": "bench", "tools": "http://127.0.0.1:1/"})
+        self.assertEqual(self.sbox.tools_rootstrap, None)
+        self.sbox.remove("bench")
+
+    def test_session_pool(self):
+        """Pooled sessions are created and removed directly."""
+
+        self.sbox.session_pool = SessionPool(self.env.path("sessions"))
+        self.sbox.setup({"name": "bench"})
+        self.assertEqual(len(self.sbox.session_pool.sessions("bench")), 1)
+        self.sbox.remove("bench")
+        self.assertEqual(self.sbox.session_pool.sessions("bench"), [])
+
+if __name__ == "__main__":
+    unittest.main()